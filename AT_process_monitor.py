@@ -42,7 +42,7 @@ def check_database_and_table(db_path, tbl_name):
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
         try:
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
+            cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view');")
             tables = cursor.fetchall()
             if tbl_name in [table[0] for table in tables]:
                 return True
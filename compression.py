@@ -0,0 +1,194 @@
+import logging
+
+NONE = "none"
+DEADBAND = "deadband"
+SWINGING_DOOR = "swinging_door"
+POLICIES = (NONE, DEADBAND, SWINGING_DOOR)
+
+SECTION = "compression"
+TOPIC_SECTION_PREFIX = "compression:"
+
+# Window rows are (timestamp, sensor_id, value, sample_count, min_value, max_value, sum_value, first_value,
+# last_value); filters look at the average and the envelope.
+VALUE, MIN_VALUE, MAX_VALUE = 2, 4, 5
+
+
+class PassThroughFilter:
+    def offer(self, moment, row):
+        return [row]
+
+    def flush(self):
+        return []
+
+
+class DeadbandFilter:
+    """Keeps a window only when it leaves the ±``deviation`` band around the last stored value,
+    or when ``max_interval`` seconds have passed since that value was stored."""
+
+    def __init__(self, deviation, max_interval):
+        self.deviation = deviation
+        self.max_interval = max_interval
+        self.last_value = None
+        self.last_moment = None
+
+    def offer(self, moment, row):
+        last_value = self.last_value
+        if (last_value is None
+                or moment - self.last_moment >= self.max_interval
+                or abs(row[VALUE] - last_value) > self.deviation
+                or row[MAX_VALUE] - last_value > self.deviation
+                or last_value - row[MIN_VALUE] > self.deviation):
+            self.last_value = row[VALUE]
+            self.last_moment = moment
+            return [row]
+        return []
+
+    def flush(self):
+        return []
+
+
+class SwingingDoorFilter:
+    """Swinging-door trending over the window averages.
+
+    The last offered window is held back until a later window proves it was a turning point; the stored
+    points then reconstruct the curve by linear interpolation within ±``deviation``. Windows with a spike
+    wider than the corridor are always stored.
+    """
+
+    def __init__(self, deviation, max_interval):
+        self.deviation = deviation
+        self.max_interval = max_interval
+        self.archived = None
+        self.held = None
+        self.slope_upper = None
+        self.slope_lower = None
+
+    def _fits(self, moment, value):
+        archived_moment, archived_value = self.archived
+        elapsed = moment - archived_moment
+        if elapsed <= 0:
+            return abs(value - archived_value) <= self.deviation
+        slope_upper = (value - archived_value - self.deviation) / elapsed
+        slope_lower = (value - archived_value + self.deviation) / elapsed
+        if self.slope_upper is not None:
+            slope_upper = max(slope_upper, self.slope_upper)
+            slope_lower = min(slope_lower, self.slope_lower)
+        # The stored segment runs from the archived point straight to this one, so its slope has to stay
+        # inside the corridor left by every point in between
+        if not slope_upper <= (value - archived_value) / elapsed <= slope_lower:
+            return False
+        self.slope_upper = slope_upper
+        self.slope_lower = slope_lower
+        return True
+
+    def _archive(self, moment, row):
+        self.archived = (moment, row[VALUE])
+        self.slope_upper = None
+        self.slope_lower = None
+
+    def offer(self, moment, row):
+        if self.archived is None:
+            self._archive(moment, row)
+            return [row]
+
+        stored = []
+        spike = row[MAX_VALUE] - row[MIN_VALUE] > 2 * self.deviation
+        if self.held is not None and (spike or moment - self.archived[0] >= self.max_interval
+                                      or not self._fits(moment, row[VALUE])):
+            held_moment, held_row = self.held
+            stored.append(held_row)
+            self._archive(held_moment, held_row)
+            self.held = None
+
+        if spike:
+            stored.append(row)
+            self._archive(moment, row)
+            return stored
+
+        if self.held is None:
+            self._fits(moment, row[VALUE])
+        self.held = (moment, row)
+        return stored
+
+    def flush(self):
+        if self.held is None:
+            return []
+        held_moment, held_row = self.held
+        self._archive(held_moment, held_row)
+        self.held = None
+        return [held_row]
+
+
+def create_filter(options):
+    policy = options.get("policy", NONE)
+    deviation = float(options.get("deviation", 0.1))
+    max_interval = float(options.get("max_interval", 600))
+    if policy == DEADBAND:
+        return DeadbandFilter(deviation, max_interval)
+    if policy == SWINGING_DOOR:
+        return SwingingDoorFilter(deviation, max_interval)
+    if policy != NONE:
+        logging.warning(f"Unknown compression policy '{policy}', storing every window")
+    return PassThroughFilter()
+
+
+def options_for(config_data, topic):
+    """Compression options of ``topic``: the [compression] defaults overridden by its [compression:<topic>]
+    section."""
+    options = dict(config_data[SECTION]) if config_data.has_section(SECTION) else {}
+    section = TOPIC_SECTION_PREFIX + topic
+    if config_data.has_section(section):
+        options.update(config_data[section])
+    return options
+
+
+def max_silence(options):
+    """Longest time in seconds a steady sensor can go without a stored row, or None when every window is
+    stored."""
+    if options.get("policy", NONE) not in (DEADBAND, SWINGING_DOOR):
+        return None
+    return float(options.get("max_interval", 600))
+
+
+class Compressor:
+    """Per-topic compression of flush-window rows, configured by the [compression] section of
+    data-collector.conf and overridden per topic by [compression:<topic>] sections."""
+
+    def __init__(self, config_data, registry):
+        self.config_data = config_data
+        self.registry = registry
+        self.filters = {}
+        self.offered = {}
+        self.stored = {}
+
+    def filter_for(self, sensor_id):
+        sensor_filter = self.filters.get(sensor_id)
+        if sensor_filter is None:
+            options = options_for(self.config_data, self.registry.get_topic(sensor_id))
+            sensor_filter = self.filters[sensor_id] = create_filter(options)
+        return sensor_filter
+
+    def compress(self, moment, rows):
+        kept = []
+        for row in rows:
+            sensor_id = row[1]
+            stored = self.filter_for(sensor_id).offer(moment, row)
+            self.offered[sensor_id] = self.offered.get(sensor_id, 0) + 1
+            self.stored[sensor_id] = self.stored.get(sensor_id, 0) + len(stored)
+            kept.extend(stored)
+        return kept
+
+    def flush(self):
+        kept = []
+        for sensor_id, sensor_filter in self.filters.items():
+            stored = sensor_filter.flush()
+            self.stored[sensor_id] = self.stored.get(sensor_id, 0) + len(stored)
+            kept.extend(stored)
+        return kept
+
+    def ratio(self, sensor_id=None):
+        if sensor_id is None:
+            offered, stored = sum(self.offered.values()), sum(self.stored.values())
+        else:
+            offered, stored = self.offered.get(sensor_id, 0), self.stored.get(sensor_id, 0)
+        return offered / stored if stored else None
@@ -1,4 +1,5 @@
 import os
+import asyncio
 import logging
 import configparser
 import sqlite3
@@ -7,11 +8,22 @@ import time
 from datetime import datetime, timedelta
 import random
 import signal
-import sys
+from collections import deque
 
 import pytz
 import paho.mqtt.client as mqtt_client
 
+import event_bus
+import partitioning
+import timestamps
+from compression import Compressor
+from db_migrations import SENSORS_DATA_MIGRATIONS, migrate
+from partitioning import TEMP_RECORDS_COLUMNS
+from sensor_registry import SensorRegistry
+from spool import Spool
+
+BROKER_SECTION_PREFIX = "mqtt:"
+
 
 def load_config(config_file):
     config_data = configparser.ConfigParser()
@@ -19,12 +31,32 @@ def load_config(config_file):
         config_data.read(config_file)
     else:
         # create default config
+        # More brokers can be added as [mqtt:<name>] sections, which replace [mqtt]
         config_data["mqtt"] = {
             "broker": "10.10.0.3",
             "port": "1883",
+            "subscribe": "#",
         }
         config_data["database"] = {
-            "name": "instance/sensors_data.db"
+            "name": "instance/sensors_data.db",
+            "timestamp_format": "iso",
+            "partition_period": "monthly",
+        }
+        config_data["buffer"] = {
+            "capacity": "10000",
+            "overflow": "drop_oldest",
+            "flush_size": "500",
+            "flush_interval": "60",
+        }
+        config_data["spool"] = {
+            "path": "instance/ingest.spool",
+            "capacity": "100000",
+        }
+        # Per-topic overrides go into [compression:<topic>] sections
+        config_data["compression"] = {
+            "policy": "none",
+            "deviation": "0.1",
+            "max_interval": "600",
         }
         os.makedirs(os.path.dirname(config_file), exist_ok=True)
         with open(config_file, 'w') as configfile:
@@ -36,9 +68,16 @@ def load_config(config_file):
 config = load_config(os.path.join('instance', 'data-collector.conf'))
 
 # Use configuration variables
-mqtt_broker = config.get('mqtt', 'broker', fallback="localhost")
-mqtt_port = config.getint('mqtt', 'port', fallback=1883)
 db_name = config.get('database', 'name', fallback="instance/sensors_data.db")
+# Applies to new databases only; existing ones are switched with devtools/convert_timestamps.py
+timestamp_format = config.get('database', 'timestamp_format', fallback=timestamps.ISO)
+partition_period = config.get('database', 'partition_period', fallback=partitioning.MONTHLY)
+buffer_capacity = config.getint('buffer', 'capacity', fallback=10000)
+buffer_overflow = config.get('buffer', 'overflow', fallback="drop_oldest")
+flush_size = config.getint('buffer', 'flush_size', fallback=500)
+flush_interval = config.getint('buffer', 'flush_interval', fallback=60)
+spool_path = config.get('spool', 'path', fallback="instance/ingest.spool")
+spool_capacity = config.getint('spool', 'capacity', fallback=100000)
 
 
 initial_timestamp = datetime.now(pytz.UTC).isoformat()
@@ -51,166 +90,623 @@ logging.basicConfig(
 logging.info('Application started')
 
 
-class MQTTClient:
-    def __init__(self, broker, port, max_retries=3):
+class RingBuffer:
+    """Fixed-capacity queue between one producer thread and one consumer thread.
+
+    Slots are preallocated. The producer only moves ``reserved``/``tail`` and the consumer only moves
+    ``head``, so neither side takes a lock. The overflow policy decides what happens when the buffer is full:
+    ``drop_oldest`` overwrites the oldest unread slot, ``drop_newest`` rejects the incoming item and
+    ``block`` makes the producer wait until the consumer drains.
+    """
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+    BLOCK = "block"
+
+    def __init__(self, capacity, overflow=DROP_OLDEST):
+        if overflow not in (self.DROP_OLDEST, self.DROP_NEWEST, self.BLOCK):
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.capacity = capacity
+        self.overflow = overflow
+        self.slots = [None] * capacity
+        self.head = 0
+        self.reserved = 0
+        self.tail = 0
+        self.high_water = 0
+        self.dropped = 0
+        self.not_full = threading.Event()
+
+    @property
+    def depth(self):
+        return min(self.tail - self.head, self.capacity)
+
+    def put(self, item):
+        tail = self.tail
+        if tail - self.head >= self.capacity:
+            if self.overflow == self.DROP_NEWEST:
+                self.dropped += 1
+                return False
+            if self.overflow == self.BLOCK:
+                while tail - self.head >= self.capacity:
+                    self.not_full.clear()
+                    if tail - self.head < self.capacity:
+                        break
+                    self.not_full.wait(1)
+            # DROP_OLDEST overwrites the slot; the consumer notices and counts the loss
+
+        self.reserved = tail + 1
+        self.slots[tail % self.capacity] = item
+        self.tail = tail + 1
+
+        depth = self.depth
+        if depth > self.high_water:
+            self.high_water = depth
+        return True
+
+    def drain(self):
+        head = self.head
+        tail = self.tail
+        start = max(head, tail - self.capacity)
+        items = [self.slots[i % self.capacity] for i in range(start, tail)]
+
+        # Anything the producer reserved while we were copying may have overwritten the oldest slots
+        first_valid = min(max(start, self.reserved - self.capacity), tail)
+        items = items[first_valid - start:]
+        if first_valid > head:
+            self.dropped += first_valid - head
+
+        self.head = tail
+        self.not_full.set()
+        return items
+
+
+class BrokerConnection:
+    """One MQTT broker whose paho client socket is serviced by the ingest engine's event loop.
+
+    Instead of a network thread per client, paho's socket callbacks register the socket with asyncio
+    (``add_reader``/``add_writer``) and a small coroutine drives ``loop_misc`` for keepalives. Connection
+    failures and disconnects are retried with exponential backoff for as long as the engine runs.
+    """
+
+    def __init__(self, name, broker, port, subscriptions=("#",), topic_prefix="", keepalive=60, max_delay=60):
+        self.name = name
+        self.broker = broker
+        self.port = port
+        self.subscriptions = list(subscriptions)
+        self.topic_prefix = topic_prefix
+        self.keepalive = keepalive
+        self.max_delay = max_delay
         self.client = mqtt_client.Client()
         self.client.on_connect = self.on_connect
-        self.client.on_disconnect = MQTTClient.on_disconnect
+        self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
-        self.broker = broker
-        self.port = port
-        self.data_buffer = []
-        self.max_retries = max_retries
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+        self.engine = None
+        self.loop = None
+        self.loop_thread = None
+        self.sock_fd = None
+        self.misc_task = None
+        self.disconnected = None
+        self.retries = 0
+        self.messages = 0
+        self.running = True
+
+    def _on_loop(self, callback, *args):
+        # paho.connect() runs in an executor thread, everything else happens on the loop thread
+        if threading.get_ident() == self.loop_thread:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self.sock_fd = sock.fileno()
+        self._on_loop(self._watch_socket, self.sock_fd)
+
+    def on_socket_close(self, client, userdata, sock):
+        self._on_loop(self._unwatch_socket, self.sock_fd)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._on_loop(self.loop.add_writer, self.sock_fd, self.client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._on_loop(self.loop.remove_writer, self.sock_fd)
+
+    def _watch_socket(self, sock_fd):
+        self.loop.add_reader(sock_fd, self.client.loop_read)
+        self.misc_task = self.loop.create_task(self.misc_loop())
+
+    def _unwatch_socket(self, sock_fd):
+        self.loop.remove_reader(sock_fd)
+        self.loop.remove_writer(sock_fd)
+        if self.misc_task is not None:
+            self.misc_task.cancel()
+            self.misc_task = None
+
+    async def misc_loop(self):
+        while self.client.loop_misc() == mqtt_client.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
 
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
-            logging.info(f"Connected to MQTT broker {self.broker}:{self.port}")
-            self.client.subscribe("#")
+            self.retries = 0
+            logging.info(f"[{self.name}] Connected to MQTT broker {self.broker}:{self.port}, "
+                         f"subscribing to {', '.join(self.subscriptions)}")
+            self.client.subscribe([(topic_filter, 0) for topic_filter in self.subscriptions])
         else:
-            logging.error("Connection failed")
+            logging.error(f"[{self.name}] Connection refused: {mqtt_client.connack_string(rc)}")
 
-    @staticmethod
-    def on_disconnect(client, userdata, rc):
+    def on_disconnect(self, client, userdata, rc):
         if rc != 0:
-            logging.warning("Unexpected disconnection")
+            logging.warning(f"[{self.name}] Unexpected disconnection: {mqtt_client.error_string(rc)}")
+        self._on_loop(self._set_disconnected, rc)
+
+    def _set_disconnected(self, rc):
+        if self.disconnected is not None and not self.disconnected.done():
+            self.disconnected.set_result(rc)
 
     def on_message(self, client, userdata, message):
+        self.messages += 1
+        self.engine.on_message(self.topic_prefix + message.topic, message.payload)
+
+    async def backoff(self, reason):
+        self.retries += 1
+        delay = min(pow(2, self.retries), self.max_delay) + random.random()
+        logging.error(f"[{self.name}] {reason}. Retry attempt {self.retries} in {delay:.1f} seconds")
+        await asyncio.sleep(delay)
+
+    async def run(self, engine):
+        self.engine = engine
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        while self.running:
+            self.disconnected = self.loop.create_future()
+            try:
+                # connect() resolves the name and opens the TCP connection synchronously
+                await self.loop.run_in_executor(None, self.client.connect, self.broker, self.port, self.keepalive)
+            except Exception as e:
+                await self.backoff(f"Failed to connect to MQTT broker {self.broker}:{self.port}: {str(e)}")
+                continue
+
+            rc = await self.disconnected
+            if self.running:
+                await self.backoff(f"Lost connection to MQTT broker {self.broker}:{self.port} (rc={rc})")
+
+    def stop(self):
+        self.running = False
+        self.client.disconnect()
+
+
+def load_brokers(config_data):
+    """Brokers from the [mqtt:<name>] sections, or the single [mqtt] section of older configs."""
+    sections = [section for section in config_data.sections() if section.startswith(BROKER_SECTION_PREFIX)]
+    if not sections:
+        sections = ["mqtt"]
+
+    brokers = []
+    for section in sections:
+        options = config_data[section] if config_data.has_section(section) else {}
+        subscriptions = [topic_filter.strip() for topic_filter in options.get("subscribe", "#").split(",")]
+        brokers.append(BrokerConnection(
+            section.split(":", 1)[-1],
+            options.get("broker", "localhost"),
+            int(options.get("port", 1883)),
+            [topic_filter for topic_filter in subscriptions if topic_filter],
+            topic_prefix=options.get("topic_prefix", ""),
+            keepalive=int(options.get("keepalive", 60)),
+        ))
+    return brokers
+
+
+class IngestEngine(threading.Thread):
+    """Runs every broker connection on one asyncio event loop, feeding a shared RingBuffer.
+
+    All messages are produced on the loop thread, so the buffer keeps a single producer. ``data_ready`` is
+    set once ``flush_threshold`` samples are waiting, which lets the processor flush on queue depth
+    instead of polling. Every sample accepted by the buffer is also appended to the ``spool``, so the spool
+    sequence number of a buffer slot is ``spool.base_seq`` plus its buffer index. The ``block`` overflow
+    policy is rejected: the producer is the event loop itself, so waiting for room would stall every broker
+    and the keepalives along with it. For the same reason a topic seen for the first time is registered in
+    sensors_data.db on an executor thread; its samples wait in ``unresolved`` until the id is known.
+    """
+
+    def __init__(self, brokers, registry, buffer_size=10000, overflow=RingBuffer.DROP_OLDEST, flush_threshold=500,
+                 spool=None):
+        super().__init__(name="ingest")
+        if overflow == RingBuffer.BLOCK:
+            raise ValueError(f"The '{RingBuffer.BLOCK}' overflow policy cannot be used with the ingest engine, "
+                             f"use '{RingBuffer.DROP_OLDEST}' or '{RingBuffer.DROP_NEWEST}'")
+        self.brokers = brokers
+        self.registry = registry
+        self.data_buffer = RingBuffer(buffer_size, overflow)
+        self.spool = spool
+        self.drained_seq = spool.base_seq - 1 if spool is not None else 0
+        self.flush_threshold = flush_threshold
+        self.data_ready = threading.Event()
+        self.unresolved = {}
+        self.registrations = set()
+        self.loop = None
+        self.stopping = None
+        self.started = threading.Event()
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
         try:
-            topic = message.topic
-            value = float(message.payload.decode("utf-8"))
-            msg_timestamp = datetime.now(pytz.UTC).isoformat()
-            self.data_buffer.append((msg_timestamp, topic, value))
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+
+    async def serve(self):
+        self.stopping = asyncio.Event()
+        tasks = [asyncio.create_task(broker.run(self)) for broker in self.brokers]
+        self.started.set()
+        await self.stopping.wait()
+
+        for broker in self.brokers:
+            broker.stop()
+        # Connected brokers finish once their DISCONNECT is sent; the rest are sleeping in backoff
+        done, pending = await asyncio.wait(tasks, timeout=5)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Samples of topics still being registered go into the buffer before the processor's last flush
+        await asyncio.gather(*self.registrations, return_exceptions=True)
+
+    def stop(self):
+        if self.started.wait(5):
+            self.loop.call_soon_threadsafe(self.stopping.set)
+
+    def on_message(self, topic, payload):
+        try:
+            value = float(payload.decode("utf-8"))
+            received = timestamps.now_ms()
+            sensor_id = self.registry.lookup(topic)
+            if sensor_id is None:
+                self.register(topic, received, value)
+            else:
+                self.store((received, sensor_id, value))
         except ValueError as ve:
             logging.error(f"Could not convert MQTT message to float: {str(ve)}")
         except Exception as e:
             logging.error(f"Unexpected error while processing MQTT message: {str(e)}")
+        if self.data_buffer.depth >= self.flush_threshold:
+            self.data_ready.set()
+
+    def store(self, sample):
+        if self.data_buffer.put(sample) and self.spool is not None:
+            self.spool.append(sample)
+
+    def register(self, topic, received, value):
+        waiting = self.unresolved.get(topic)
+        if waiting is not None:
+            waiting.append((received, value))
+            return
+        self.unresolved[topic] = [(received, value)]
+        registration = self.loop.run_in_executor(None, self.registry.get_id, topic)
+        self.registrations.add(registration)
+        registration.add_done_callback(lambda done: self.on_registered(topic, done))
+
+    def on_registered(self, topic, registration):
+        # Done callbacks run on the loop thread, so the buffer keeps its single producer
+        self.registrations.discard(registration)
+        samples = self.unresolved.pop(topic)
+        try:
+            sensor_id = registration.result()
+        except (Exception, asyncio.CancelledError) as e:
+            logging.error(f"Failed to register topic {topic}, dropped {len(samples)} samples: {str(e)}")
+            return
+        for received, value in samples:
+            self.store((received, sensor_id, value))
+        if self.data_buffer.depth >= self.flush_threshold:
+            self.data_ready.set()
+
+    def wait_for_data(self, timeout):
+        ready = self.data_ready.wait(timeout)
+        self.data_ready.clear()
+        return ready
 
-    def connect(self):
-        retries = 0
-        while retries < self.max_retries:
-            try:
-                self.client.connect(self.broker, self.port)
-                return
-            except Exception as e:
-                retries += 1
-                delay = pow(2, retries) + random.random()
-                logging.error(f"Failed to connect to MQTT broker: {str(e)}. Retry attempt {retries} in {delay} seconds")
-                time.sleep(delay)
-            finally:
-                self.client.loop_stop()
-
-        logging.error(f"Failed to connect to MQTT broker after {self.max_retries} attempts. Exiting.")
-        sys.exit(1)
-
-    def loop_start(self):
-        self.client.loop_start()
+    def fetch_and_clear_data(self):
+        items = self.data_buffer.drain()
+        if self.spool is not None:
+            self.drained_seq = self.spool.base_seq + self.data_buffer.head - 1
+        return items
 
-    def loop_stop(self):
-        self.client.loop_stop()
+    def commit_spool(self):
+        """Called after everything fetched so far has been written to the database."""
+        if self.spool is not None:
+            self.spool.commit(self.drained_seq)
 
-    def disconnect(self):
-        self.client.disconnect()
 
-    def fetch_and_clear_data(self):
-        data = self.data_buffer[:]
-        self.data_buffer.clear()
-        return data
+INSERT_RECORD_SQL = "INSERT INTO {table} (" + TEMP_RECORDS_COLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
 
 
 class DatabaseManager:
-    def __init__(self, database_name, max_retries=3):
+    def __init__(self, database_name, max_retries=3, partition_period=partitioning.MONTHLY):
         self.db_name = database_name
         self.max_retries = max_retries
+        self.partition_period = partition_period
+        self.conn = None
+        self.router = None
+        self.next_id = None
+        self.timestamp_format = timestamps.ISO
 
     def __enter__(self):
-        self.conn = sqlite3.connect(self.db_name, isolation_level=None)
-        self.conn.execute("pragma journal_mode=wal")
+        self.open()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.conn.close()
+        self.close()
+
+    def open(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_name, isolation_level=None)
+            self.conn.execute("pragma journal_mode=wal")
+            self.timestamp_format = timestamps.get_format(self.conn)
+            self.router = None
+            self.next_id = None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def get_router(self):
+        if self.router is None:
+            self.router = partitioning.PartitionRouter(self.conn, self.partition_period, self.timestamp_format)
+        return self.router
 
     def execute_with_retry(self, sql, params=()):
+        self.write_batches_with_retry([(sql, [params])])
+
+    def executemany_with_retry(self, sql, seq_of_params):
+        self.write_batches_with_retry([(sql, seq_of_params)])
+
+    def write_batches_with_retry(self, batches):
+        # All batches are written in one transaction, so a retry replays them as a unit
         retries = 0
-        while retries < self.max_retries:
+        while True:
             try:
-                self.conn.execute(sql, params)
-                self.conn.commit()
+                self.conn.execute("BEGIN IMMEDIATE")
+                for sql, seq_of_params in batches:
+                    self.conn.executemany(sql, seq_of_params)
+                self.conn.execute("COMMIT")
                 return
-            except Exception as e:
-                logging.error(f"Failed to execute SQL query: {str(e)}")
+            except sqlite3.Error as e:
+                if self.conn.in_transaction:
+                    self.conn.execute("ROLLBACK")
                 retries += 1
-                time.sleep(5)
-
-        logging.error(f"Failed to execute SQL query after {self.max_retries} attempts. Exiting.")
-        sys.exit(1)
+                if retries >= self.max_retries:
+                    logging.error(f"Failed to write batch after {self.max_retries} attempts: {str(e)}")
+                    raise
+                delay = pow(2, retries) + random.random()
+                logging.error(f"Failed to write batch: {str(e)}. Retry attempt {retries} in {delay} seconds")
+                time.sleep(delay)
 
-    def initialize(self):
+    def initialize(self, requested_format=timestamps.ISO):
         with self:
-            self.execute_with_retry(
-                "CREATE TABLE IF NOT EXISTS temp_records (timestamp, topic, value)"
-            )
-
-    def insert(self, db_timestamp, topic, value):
-        self.execute_with_retry(
-            "INSERT INTO temp_records (timestamp, topic, value) VALUES (?, ?, ?)",
-            (db_timestamp, topic, value)
-        )
+            self.init_timestamp_format(requested_format)
+            migrate(self.conn, SENSORS_DATA_MIGRATIONS, self.db_name)
+            # Make sure the temp_records view exists before the other processes start reading it
+            self.get_router().partition_for(timestamps.now(self.timestamp_format))
+
+    def init_timestamp_format(self, requested_format):
+        tables = [row[0] for row in
+                  self.conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")]
+        if "meta" in tables:
+            self.timestamp_format = timestamps.get_format(self.conn)
+            if self.timestamp_format != requested_format:
+                logging.warning(f"Database stores {self.timestamp_format} timestamps, ignoring configured "
+                                f"{requested_format}. Use devtools/convert_timestamps.py to convert it.")
+            return
+
+        # Data written before the option existed is ISO-8601 text
+        has_data = ("temp_records" in tables and
+                    self.conn.execute("SELECT 1 FROM temp_records LIMIT 1").fetchone() is not None)
+        self.timestamp_format = timestamps.ISO if has_data else requested_format
+        timestamps.set_format(self.conn, self.timestamp_format)
+
+    def insert(self, db_timestamp, sensor_id, value, aggregate=None):
+        if aggregate is None:
+            aggregate = (1, value, value, value, value, value)
+        self.insert_many([(db_timestamp, sensor_id, value, *aggregate)])
+
+    def insert_many(self, rows):
+        router = self.get_router()
+        if self.next_id is None:
+            # Ids stay monotonic across partitions, so readers can use them as a watermark
+            self.next_id = router.max_id() + 1
+
+        partition_rows = {}
+        next_id = self.next_id
+        for row in rows:
+            partition_rows.setdefault(router.partition_for(row[0]), []).append((next_id, *row))
+            next_id += 1
+
+        self.write_batches_with_retry([(INSERT_RECORD_SQL.format(table=table), table_rows)
+                                       for table, table_rows in partition_rows.items()])
+        self.next_id = next_id
 
     def delete_old(self):
-        six_months_ago = (datetime.now(pytz.UTC) - timedelta(days=180)).isoformat()
-        self.execute_with_retry(
-            "DELETE FROM temp_records WHERE timestamp < ?",
-            (six_months_ago,)
-        )
+        cutoff = datetime.now(pytz.UTC) - timedelta(days=180)
+        dropped = self.get_router().drop_older_than(cutoff)
+        if dropped:
+            logging.info(f"Dropped expired partitions: {', '.join(dropped)}")
 
 
 class DataProcessor(threading.Thread):
-    def __init__(self, mqtt, database_name, max_buffer_size=500):
+    def __init__(self, ingest, database_name, max_buffer_size=500, flush_interval=60,
+                 partition_period=partitioning.MONTHLY, compressor=None):
         super().__init__()
-        self.mqtt = mqtt
+        self.ingest = ingest
         self.db_name = database_name
         self.max_buffer_size = max_buffer_size
+        self.flush_interval = flush_interval
         self.running = True
+        self.stopping = threading.Event()
+        self.db_manager = DatabaseManager(database_name, partition_period=partition_period)
+        self.compressor = compressor
+        self.rows_written = 0
+        self.last_flush_latency = None
+        # Wakes incident_detector as soon as a window is in the database
+        self.events = event_bus.Publisher(event_bus.RECORDS)
 
     def run(self):
         data = []
-        last_flush_time = datetime.now(pytz.UTC)
-        while self.running:
-            try:
-                time.sleep(1)
-            except KeyboardInterrupt:
-                return
-            if not self.running:
-                break
-            try:
-                data.extend(self.mqtt.fetch_and_clear_data())
-                if len(data) >= self.max_buffer_size or (datetime.now(pytz.UTC) - last_flush_time).seconds >= 60:
-                    self.flush_data(data)
-                    last_flush_time = datetime.now(pytz.UTC)
-                    data.clear()
-            except Exception as e:
-                logging.error(f"Failed to process data: {str(e)}")
+        # Rows of windows the database has not accepted yet, oldest first. While any are held the engine is not
+        # drained, so a stall backs up into the ring buffer and its overflow policy instead of into memory here
+        held = deque()
+        next_flush = time.monotonic() + self.flush_interval
+        # One connection for the lifetime of the thread, so sqlite3 keeps the prepared INSERT cached
+        with self.db_manager:
+            held.extend(self.replay_spool())
+            while self.running:
+                timeout = max(next_flush - time.monotonic(), 0)
+                if held:
+                    # Held windows are retried once per flush interval, however fast samples arrive
+                    self.stopping.wait(timeout)
+                else:
+                    # Wakes up when the engine has max_buffer_size samples waiting, or when the window ends
+                    self.ingest.wait_for_data(timeout)
+                if not self.running:
+                    break
+                try:
+                    if not held:
+                        data.extend(self.ingest.fetch_and_clear_data())
+                        if len(data) < self.max_buffer_size and time.monotonic() < next_flush:
+                            continue
+                        held.extend(self.close_windows(data))
+                        data = []
+                    elif time.monotonic() < next_flush:
+                        continue
+                    # On failure the windows stay held, and their samples stay in the spool
+                    self.write_held(held)
+                    next_flush = time.monotonic() + self.flush_interval
+                except Exception as e:
+                    logging.error(f"Failed to process data: {str(e)}")
+
+            # Do not lose the last window or the points held back by the compression filters
+            data.extend(self.ingest.fetch_and_clear_data())
+            held.extend(self.close_windows(data))
+            if self.compressor is not None:
+                held.append(self.compressor.flush())
+            self.write_held(held)
+        self.events.close()
+
+    def replay_spool(self):
+        """Write the samples a previous run accepted but never flushed; returns their rows if that fails."""
+        spool = self.ingest.spool
+        if spool is None:
+            return []
+        samples, last_seq = spool.replay()
+        if not samples:
+            return []
+
+        logging.info(f"Replaying {len(samples)} unflushed samples from {spool.path}")
+        window_end = timestamps.coerce(max(sample[0] for sample in samples), self.db_manager.timestamp_format)
+        rows = self.window_rows(samples, window_end)
+        if self.write_rows(rows):
+            spool.commit(last_seq)
+            return []
+        return [rows]
+
+    def close_windows(self, samples):
+        """Rows of the flush windows the samples fall into, oldest first.
+
+        Samples normally span one window, stamped with the flush time. Samples that waited out a database
+        stall in the ingest buffer span several: they are cut into ``flush_interval`` windows by receive time
+        and each earlier window is stamped with its newest sample, as replayed windows are.
+        """
+        timestamp_format = self.db_manager.timestamp_format
+        interval_ms = self.flush_interval * 1000
+        windows = []
+        start = 0
+        if samples and samples[-1][0] - samples[0][0] > 2 * interval_ms:
+            for index in range(1, len(samples)):
+                if samples[index][0] - samples[start][0] >= interval_ms:
+                    windows.append(samples[start:index])
+                    start = index
+        rows = [self.window_rows(window, timestamps.coerce(window[-1][0], timestamp_format)) for window in windows]
+        rows.append(self.window_rows(samples[start:], timestamps.now(timestamp_format)))
+        return rows
+
+    def write_held(self, held):
+        """Write held windows oldest first; the spool is committed once none is left."""
+        while held:
+            if not self.write_rows(held[0]):
+                logging.warning(f"{len(held)} windows wait for the database, the ingest buffer is not drained "
+                                f"until they are written")
+                return False
+            held.popleft()
+        self.ingest.commit_spool()
+        return True
 
-    def flush_data(self, data):
-        topic_values = {}
-        for msg_timestamp, topic, value in data:
-            if topic not in topic_values:
-                topic_values[topic] = []
-            topic_values[topic].append(value)
+    @staticmethod
+    def aggregate(data):
+        """Reduce the samples of one flush window to [count, min, max, sum, first, last] per sensor."""
+        sensor_aggregates = {}
+        for msg_timestamp, sensor_id, value in data:
+            aggregate = sensor_aggregates.get(sensor_id)
+            if aggregate is None:
+                sensor_aggregates[sensor_id] = [1, value, value, value, value, value]
+            else:
+                aggregate[0] += 1
+                if value < aggregate[1]:
+                    aggregate[1] = value
+                if value > aggregate[2]:
+                    aggregate[2] = value
+                aggregate[3] += value
+                aggregate[5] = value
+        return sensor_aggregates
+
+    def window_rows(self, data, db_timestamp):
+        """Aggregate and compress one window; done once per window, so a retried write does not run the
+        compression filters twice."""
+        rows = []
+        for sensor_id, (count, min_value, max_value, sum_value, first_value, last_value) in self.aggregate(data).items():
+            avg_value = round(sum_value / count, 2)
+            rows.append((db_timestamp, sensor_id, avg_value, count, min_value, max_value, sum_value,
+                         first_value, last_value))
+            logging.debug(f"Window aggregate: sensor_id={sensor_id}, avg={avg_value}, count={count}, "
+                          f"min={min_value}, max={max_value}, timestamp={db_timestamp}")
+
+        if self.compressor is not None and rows:
+            window_size = len(rows)
+            rows = self.compressor.compress(timestamps.to_epoch_ms(db_timestamp) / 1000, rows)
+            ratio = self.compressor.ratio()
+            ratio_text = f"{ratio:.1f}:1" if ratio else "n/a"
+            logging.info(f"Compression: kept {len(rows)} of {window_size} window rows, overall ratio {ratio_text}")
+
+        return rows
+
+    def write_rows(self, rows):
+        if not rows:
+            return True
 
         try:
-            with DatabaseManager(self.db_name) as db_manager:
-                for topic, values in topic_values.items():
-                    avg_value = round(sum(values) / len(values), 2)
-                    db_timestamp = datetime.now(pytz.UTC).isoformat()
-                    db_manager.insert(db_timestamp, topic, avg_value)
-                    logging.debug(f"Saved average data: topic={topic}, value={avg_value}, timestamp={db_timestamp}")
-        except sqlite3.OperationalError as e:
+            started = time.perf_counter()
+            self.db_manager.insert_many(rows)
+            self.last_flush_latency = time.perf_counter() - started
+            self.rows_written += len(rows)
+            self.events.publish(rows=len(rows))
+            logging.info(f"Flushed {len(rows)} rows in {self.last_flush_latency * 1000:.1f} ms "
+                         f"({len(rows) / max(self.last_flush_latency, 1e-9):.0f} rows/s, "
+                         f"{self.rows_written} rows total)")
+            buffer = self.ingest.data_buffer
+            logging.info(f"Ingest buffer: depth={buffer.depth}, high water={buffer.high_water}/{buffer.capacity}, "
+                         f"dropped={buffer.dropped}")
+            spool = self.ingest.spool
+            if spool is not None:
+                logging.info(f"Spool: depth={spool.depth}/{spool.capacity}, overruns={spool.overruns}")
+            return True
+        except sqlite3.Error as e:
             logging.error(f"Failed to flush data to database: {str(e)}")
+            return False
 
     def stop(self):
         self.running = False
+        self.stopping.set()
+        self.ingest.data_ready.set()
 
 
 class DataCleaner(threading.Thread):
@@ -240,32 +736,38 @@ class DataCleaner(threading.Thread):
 
 
 def main():
-    mqtt = MQTTClient(mqtt_broker, mqtt_port)
-    mqtt.connect()
+    with DatabaseManager(db_name, partition_period=partition_period) as db_manager:
+        db_manager.initialize(timestamp_format)
 
-    with DatabaseManager(db_name) as db_manager:
-        db_manager.initialize()
+    registry = SensorRegistry(db_name)
+    registry.reload()
 
-    data_processor = DataProcessor(mqtt, db_name)
+    spool = Spool(spool_path, spool_capacity)
+    ingest = IngestEngine(load_brokers(config), registry, buffer_size=buffer_capacity, overflow=buffer_overflow,
+                          flush_threshold=flush_size, spool=spool)
+    ingest.start()
+
+    data_processor = DataProcessor(ingest, db_name, max_buffer_size=flush_size, flush_interval=flush_interval,
+                                   partition_period=partition_period, compressor=Compressor(config, registry))
     data_processor.start()
 
     data_cleaner = DataCleaner(db_name)
     data_cleaner.start()
 
-    mqtt.loop_start()
-
-    signal.signal(signal.SIGTERM, lambda signum, frame: shutdown(mqtt, data_processor, data_cleaner))
-    signal.signal(signal.SIGINT, lambda signum, frame: shutdown(mqtt, data_processor, data_cleaner))
+    signal.signal(signal.SIGTERM, lambda signum, frame: shutdown(ingest, data_processor, data_cleaner))
+    signal.signal(signal.SIGINT, lambda signum, frame: shutdown(ingest, data_processor, data_cleaner))
     signal.pause()
 
 
-def shutdown(mqtt, data_processor, data_cleaner):
-    mqtt.loop_stop()
-    mqtt.disconnect()
+def shutdown(ingest, data_processor, data_cleaner):
+    ingest.stop()
+    ingest.join()
     data_processor.stop()
     data_processor.join()
     data_cleaner.stop()
     data_cleaner.join()
+    if ingest.spool is not None:
+        ingest.spool.close()
     logging.info('Application stopped')
 
 
@@ -1,5 +1,9 @@
 import os
+import argparse
+import glob
 import logging
+import multiprocessing
+import sqlite3
 import threading
 import time
 from datetime import datetime, timedelta, timezone
@@ -7,6 +11,10 @@ from sqlite3 import Connection as SQLite3Connection
 from sqlalchemy import create_engine, event, text
 from sqlalchemy.engine import Engine
 
+import rollups
+import timestamps
+from sensor_registry import SensorRegistry, topic_to_table_name
+
 lock = threading.Lock()
 
 log_file = 'instance/data_sorter.log'
@@ -15,6 +23,21 @@ logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s [
 
 source_db_path = 'instance/sensors_data.db'
 destination_db_path = 'instance/sorted_data.db'
+staging_dir = 'instance/catch_up'
+
+# A backlog older than this is copied by the parallel catch-up before the regular cycles start
+CATCH_UP_LAG = timedelta(hours=6)
+
+# per_topic: one table per sensor; narrow: every sensor in the clustered readings table, with a
+# compatibility view per sensor under the old table name
+PER_TOPIC = "per_topic"
+NARROW = "narrow"
+STORAGE_MODES = (PER_TOPIC, NARROW)
+
+# Window min/max from the collector, kept next to the window average so rollups can show the real envelope
+ENVELOPE_COLUMNS = ("min_value", "max_value")
+
+SERVICE_TABLES = ("last_update", "watermarks", "meta", "readings", "latest_readings")
 
 os.makedirs(os.path.dirname(source_db_path), exist_ok=True)
 os.makedirs(os.path.dirname(destination_db_path), exist_ok=True)
@@ -36,122 +59,501 @@ destination_engine = create_engine(f'sqlite:///{destination_db_path}',
                                    echo=False)
 
 
+@event.listens_for(destination_engine, "connect")
+def _attach_source(dbapi_connection, connection_record):
+    # Rows are moved by INSERT ... SELECT inside SQLite instead of passing through Python
+    cursor = dbapi_connection.cursor()
+    cursor.execute("ATTACH DATABASE ? AS src", (os.path.abspath(source_db_path),))
+    cursor.close()
+
+registry = SensorRegistry(source_db_path)
+
+# Sensor tables that already have their unique timestamp index in this process
+prepared_tables = set()
+
+
 def update_and_sort_data(destination_db, source_db):
-    with source_db.begin() as source_transaction:
-        with destination_db.begin() as destination_transaction:
-            check_and_create_last_update_table(destination_db)
-            last_timestamp = get_last_update_time(destination_db)
+    timestamp_format = timestamps.get_format(source_db.connection)
+    with destination_db.begin() as destination_transaction:
+        storage_mode = get_storage_mode(destination_db)
+        check_and_create_watermarks_table(destination_db)
+        check_and_create_rollup_tables(destination_db)
+        check_and_create_latest_readings_table(destination_db)
+        watermarks = get_watermarks(destination_db)
 
-            topics = source_db.execute(text("SELECT DISTINCT topic FROM temp_records")).fetchall()
-            logging.debug(f"Topics: {topics}")
+        # The sensors dictionary is tiny, unlike SELECT DISTINCT over the whole of temp_records
+        sensor_ids = destination_db.execute(text("SELECT id FROM src.sensors")).fetchall()
+        logging.debug(f"Sensors: {sensor_ids}")
 
-            for topic in topics:
-                topic_name, max_timestamp = process_topic(destination_db, source_db, topic, last_timestamp)
-                sort_topic_data(destination_db, topic_name)
-                remove_duplicates(destination_db, topic_name)
-                if max_timestamp is not None:
-                    update_last_update_time(destination_db, max_timestamp)
+        for (sensor_id,) in sensor_ids:
+            topic_name, max_timestamp = process_topic(destination_db, sensor_id, watermarks.get(sensor_id),
+                                                      timestamp_format, storage_mode)
+            if max_timestamp is not None:
+                update_watermark(destination_db, sensor_id, max_timestamp)
+                update_latest_reading(destination_db, sensor_id, topic_name)
+            update_rollups(destination_db, sensor_id, topic_name, timestamp_format, storage_mode)
 
-    logging.debug(f"Last timestamp: {last_timestamp}")
+    logging.debug(f"Watermarks: {watermarks}")
 
 
-def remove_duplicates(destination_db, topic_name):
-    destination_db.execute(
-        text(f"CREATE TABLE IF NOT EXISTS temp_{topic_name} (id INTEGER PRIMARY KEY, timestamp TEXT, value REAL);"))
-    destination_db.execute(
-        text(f"INSERT INTO temp_{topic_name} (timestamp, value) SELECT timestamp, value "
-             f"FROM (SELECT timestamp, value FROM {topic_name} GROUP BY timestamp);"))
+def get_storage_mode(destination_db):
+    destination_db.execute(text("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"))
+    mode = destination_db.execute(text("SELECT value FROM meta WHERE key='storage_mode'")).scalar()
+    return mode or PER_TOPIC
+
+
+def set_storage_mode(destination_db, storage_mode):
+    destination_db.execute(text("INSERT OR REPLACE INTO meta (key, value) VALUES ('storage_mode', :mode)"),
+                           {"mode": storage_mode})
+
+
+def create_readings_table(destination_db, timestamp_format):
+    # Clustered on (sensor_id, timestamp): a sensor's range is one contiguous B-tree walk
     destination_db.execute(
-        text(f"DROP TABLE {topic_name};"))
+        text(f"CREATE TABLE IF NOT EXISTS readings ("
+             f"sensor_id INTEGER NOT NULL,"
+             f"timestamp {timestamps.column_type(timestamp_format)} NOT NULL,"
+             f"value REAL,"
+             f"min_value REAL,"
+             f"max_value REAL,"
+             f"PRIMARY KEY (sensor_id, timestamp)) WITHOUT ROWID"))
+    add_envelope_columns(destination_db, "readings")
+
+
+def add_envelope_columns(destination_db, table_name):
+    """Give a table created before the min/max envelope was carried over its min_value/max_value columns.
+
+    Rows copied earlier keep NULL there; readers fall back to ``value`` for them.
+    """
+    columns = [row[1] for row in destination_db.execute(text(f"PRAGMA table_info({table_name})"))]
+    for column in ENVELOPE_COLUMNS:
+        if column not in columns:
+            destination_db.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column} REAL"))
+
+
+def create_compatibility_view(destination_db, topic_name, sensor_id, timestamp_format):
+    # Same (id, timestamp, value, min_value, max_value) shape as a per-topic table; id only has to order rows
+    # by time. Recreated rather than kept, so views from before the envelope columns are replaced
+    destination_db.execute(text(f"DROP VIEW IF EXISTS {topic_name}"))
     destination_db.execute(
-        text(f"ALTER TABLE temp_{topic_name} RENAME TO {topic_name};"))
+        text(f"CREATE VIEW {topic_name} AS "
+             f"SELECT {timestamps.epoch_ms_sql('timestamp', timestamp_format)} AS id, timestamp, value, "
+             f"min_value, max_value FROM readings WHERE sensor_id = {int(sensor_id)}"))
 
 
-def check_and_create_last_update_table(destination_db):
-    destination_db.execute(text("CREATE TABLE IF NOT EXISTS last_update (timestamp TEXT)"))
-    result = destination_db.execute(text("SELECT count(*) FROM last_update"))
-    if result.fetchone()[0] == 0:
-        destination_db.execute(text("INSERT INTO last_update (timestamp) VALUES (NULL)"))
+def insert_rows_sql(topic_name, storage_mode):
+    """Start of an INSERT ... SELECT into a sensor's storage; the SELECT must bind :sensor_id."""
+    if storage_mode == NARROW:
+        return ("INSERT OR IGNORE INTO readings (sensor_id, timestamp, value, min_value, max_value) "
+                "SELECT :sensor_id, timestamp, value, min_value, max_value")
+    return (f"INSERT OR IGNORE INTO {topic_name} (timestamp, value, min_value, max_value) "
+            f"SELECT timestamp, value, min_value, max_value")
 
 
-def get_last_update_time(destination_db):
-    last_timestamp = None
-    result = destination_db.execute(text("SELECT max(timestamp) FROM last_update"))
-    result = result.fetchone()
-    if result and isinstance(result[0], str):
-        last_timestamp = result[0]
-        last_timestamp = datetime.fromisoformat(last_timestamp).replace(tzinfo=timezone.utc)
-        if last_timestamp > datetime.now(timezone.utc):
-            last_timestamp = datetime.now(timezone.utc)
-        last_timestamp = last_timestamp - timedelta(minutes=1)
-        last_timestamp = last_timestamp.isoformat()
-    return last_timestamp
+def prepare_topic_table(destination_db, sensor_id, topic_name, timestamp_format, storage_mode=PER_TOPIC):
+    """Create the sensor table with a UNIQUE index on timestamp, which keeps it free of duplicates and
+    serves timestamp order without rewriting the table. In narrow mode create its view over readings instead.
 
+    Tables left by the old copy-sort-dedupe cycle are deduplicated once, before the index is built.
+    """
+    if topic_name in prepared_tables:
+        return
 
-def process_topic(destination_db, source_db, topic, last_timestamp):
-    topic_name = topic[0].replace('/', '_')
-    destination_db.execute(
-        text(f"CREATE TABLE IF NOT EXISTS {topic_name} (id INTEGER PRIMARY KEY, timestamp TEXT, value REAL)"))
-    data = get_data_from_source(source_db, topic, last_timestamp)
+    if storage_mode == NARROW:
+        create_readings_table(destination_db, timestamp_format)
+        create_compatibility_view(destination_db, topic_name, sensor_id, timestamp_format)
+        prepared_tables.add(topic_name)
+        return
 
-    max_timestamp = None
-    for row in data:
-        timestamp, value = row
+    timestamp_type = timestamps.column_type(timestamp_format)
+    destination_db.execute(
+        text(f"CREATE TABLE IF NOT EXISTS {topic_name} "
+             f"(id INTEGER PRIMARY KEY, timestamp {timestamp_type}, value REAL, min_value REAL, max_value REAL)"))
+    add_envelope_columns(destination_db, topic_name)
+    index_name = f"{topic_name}_timestamp"
+    index_exists = destination_db.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type='index' AND name=:name"), {"name": index_name}).fetchone()
+    if not index_exists:
+        removed = destination_db.execute(
+            text(f"DELETE FROM {topic_name} WHERE id NOT IN (SELECT min(id) FROM {topic_name} GROUP BY timestamp)"))
+        if removed.rowcount:
+            logging.info(f"Removed {removed.rowcount} duplicate rows from {topic_name}")
+        destination_db.execute(text(f"CREATE UNIQUE INDEX {index_name} ON {topic_name} (timestamp)"))
+        logging.info(f"Created unique timestamp index on {topic_name}")
+    prepared_tables.add(topic_name)
+
+
+def existing_sensor_tables(destination_db, object_types=("table", "view")):
+    """(sensor_id, table name) of every registered sensor that has a table or view in sorted_data.db."""
+    registry.reload()
+    names = {row[0] for row in destination_db.execute(
+        text(f"SELECT name FROM sqlite_master WHERE type IN ({', '.join(repr(t) for t in object_types)})"))}
+    return [(sensor_id, topic_to_table_name(topic)) for sensor_id, topic in registry.items()
+            if topic_to_table_name(topic) in names]
+
+
+def check_and_create_watermarks_table(destination_db):
+    """Per-sensor watermark: the newest source timestamp already copied into the sensor's table.
+
+    The collector writes the rows of one sensor in timestamp order, so ``timestamp > watermark`` picks up
+    exactly the new rows. Sensors seen by an older sorter start from the newest row of their table.
+    """
+    exists = destination_db.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type='table' AND name='watermarks'")).fetchone()
+    if exists:
+        return
+
+    destination_db.execute(text("CREATE TABLE watermarks (sensor_id INTEGER PRIMARY KEY, timestamp NOT NULL)"))
+    for sensor_id, table_name in existing_sensor_tables(destination_db):
         destination_db.execute(
-            text(f"INSERT INTO {topic_name} (timestamp, value) VALUES (:timestamp, :value)"),
-            {"timestamp": timestamp, "value": value})
-        if max_timestamp is None or timestamp > max_timestamp:
-            max_timestamp = timestamp
-
-    logging.debug(f"Data from source: {data}")
+            text(f"INSERT INTO watermarks (sensor_id, timestamp) "
+                 f"SELECT :sensor_id, max(timestamp) FROM {table_name} WHERE timestamp IS NOT NULL "
+                 f"HAVING count(*) > 0"),
+            {"sensor_id": sensor_id})
+    destination_db.execute(text("DROP TABLE IF EXISTS last_update"))
+    logging.info("Replaced the global last_update timestamp with per-sensor watermarks")
+
+
+def check_and_create_rollup_tables(destination_db):
+    for statement in rollups.create_tables_sql():
+        destination_db.execute(text(statement))
+    columns = [row[1] for row in destination_db.execute(text(f"PRAGMA table_info({rollups.PROGRESS_TABLE})"))]
+    if "last_timestamp" not in columns:
+        destination_db.execute(text(f"ALTER TABLE {rollups.PROGRESS_TABLE} ADD COLUMN last_timestamp"))
+
+
+def update_rollups(destination_db, sensor_id, topic_name, timestamp_format, storage_mode=PER_TOPIC):
+    """Fold the rows added to a sensor since the last call into the 1m/1h/1d rollups.
+
+    Progress is tracked by row id (per-topic tables) or by timestamp (readings), so existing history is
+    rolled up on the first call and every row is counted exactly once whichever path (regular cycle or
+    catch-up) inserted it.
+    """
+    progress = destination_db.execute(
+        text(f"SELECT last_id, last_timestamp FROM {rollups.PROGRESS_TABLE} WHERE sensor_id=:sensor_id"),
+        {"sensor_id": sensor_id}).fetchone()
+    last_id, last_timestamp = progress if progress else (None, None)
+
+    if storage_mode == NARROW:
+        newest = destination_db.execute(text("SELECT max(timestamp) FROM readings WHERE sensor_id=:sensor_id"),
+                                        {"sensor_id": sensor_id}).scalar()
+        if newest is None or (last_timestamp is not None and newest <= last_timestamp):
+            return
+        params = {"sensor_id": sensor_id, "after": get_window_start(last_timestamp, timestamp_format),
+                  "until": newest}
+        for resolution, _ in rollups.RESOLUTIONS:
+            destination_db.execute(text(rollups.upsert_sql(
+                resolution, "readings", "sensor_id = :sensor_id AND timestamp > :after AND timestamp <= :until",
+                timestamp_format)), params)
+        set_rollup_progress(destination_db, sensor_id, last_id or 0, newest)
+        return
+
+    last_id = last_id or 0
+    max_id = destination_db.execute(text(f"SELECT max(id) FROM {topic_name}")).scalar()
+    if max_id is None or max_id <= last_id:
+        return
+
+    params = {"sensor_id": sensor_id, "after_id": last_id, "until_id": max_id}
+    for resolution, _ in rollups.RESOLUTIONS:
+        destination_db.execute(text(rollups.upsert_sql(
+            resolution, topic_name, "id > :after_id AND id <= :until_id", timestamp_format)), params)
+    set_rollup_progress(destination_db, sensor_id, max_id, last_timestamp)
+
+
+def set_rollup_progress(destination_db, sensor_id, last_id, last_timestamp):
+    destination_db.execute(
+        text(f"INSERT INTO {rollups.PROGRESS_TABLE} (sensor_id, last_id, last_timestamp) "
+             f"VALUES (:sensor_id, :last_id, :last_timestamp) "
+             f"ON CONFLICT (sensor_id) DO UPDATE SET last_id=excluded.last_id, last_timestamp=excluded.last_timestamp"),
+        {"sensor_id": sensor_id, "last_id": last_id, "last_timestamp": last_timestamp})
 
-    return topic_name, max_timestamp
 
+def check_and_create_latest_readings_table(destination_db):
+    """Newest reading of every sensor, so listings take one query instead of one per sensor table."""
+    exists = destination_db.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type='table' AND name='latest_readings'")).fetchone()
+    if exists:
+        return
 
-def get_data_from_source(source_db, topic, last_timestamp):
-    if last_timestamp:
-        last_timestamp = (datetime.fromisoformat(last_timestamp.replace('Z', '+00:00')) + timedelta(seconds=1)).isoformat()
-        logging.debug(f"Last timestamp before query: {last_timestamp}")
-        data = source_db.execute(
-            text(f"SELECT timestamp, value FROM temp_records WHERE topic=:topic AND timestamp>=:last_timestamp"),
-            {"topic": topic[0], "last_timestamp": last_timestamp}).fetchall()
-    else:
-        data = source_db.execute(
-            text(f"SELECT timestamp, value FROM temp_records WHERE topic=:topic"),
-            {"topic": topic[0]}).fetchall()
-    logging.debug(f"Data from query: {data}")
-    return data
+    destination_db.execute(
+        text("CREATE TABLE latest_readings (sensor_id INTEGER PRIMARY KEY, timestamp NOT NULL, value REAL)"))
+    for sensor_id, table_name in existing_sensor_tables(destination_db):
+        update_latest_reading(destination_db, sensor_id, table_name)
 
 
-def sort_topic_data(destination_db, topic_name):
+def update_latest_reading(destination_db, sensor_id, topic_name):
     destination_db.execute(
-        text(f"CREATE TABLE IF NOT EXISTS temp_{topic_name} (id INTEGER PRIMARY KEY, timestamp TEXT, value REAL);"))
-    destination_db.execute(
-        text(f"INSERT INTO temp_{topic_name} SELECT * FROM {topic_name} ORDER BY timestamp ASC;"))
-    destination_db.execute(text(f"DROP TABLE {topic_name};"))
+        text(f"INSERT INTO latest_readings (sensor_id, timestamp, value) "
+             f"SELECT :sensor_id, timestamp, value FROM {topic_name} WHERE timestamp IS NOT NULL "
+             f"ORDER BY timestamp DESC LIMIT 1 "
+             f"ON CONFLICT (sensor_id) DO UPDATE SET timestamp=excluded.timestamp, value=excluded.value"),
+        {"sensor_id": sensor_id})
+
+
+def convert_storage(destination_db, storage_mode, timestamp_format):
+    """Move every sensor between per-topic tables and the narrow readings table, in one transaction."""
+    current_mode = get_storage_mode(destination_db)
+    if current_mode == storage_mode:
+        return False
+
+    check_and_create_rollup_tables(destination_db)
+    started = time.perf_counter()
+    moved = 0
+    if storage_mode == NARROW:
+        create_readings_table(destination_db, timestamp_format)
+        for sensor_id, table_name in existing_sensor_tables(destination_db, ("table",)):
+            add_envelope_columns(destination_db, table_name)
+            update_rollups(destination_db, sensor_id, table_name, timestamp_format, PER_TOPIC)
+            moved += destination_db.execute(
+                text(f"INSERT OR IGNORE INTO readings (sensor_id, timestamp, value, min_value, max_value) "
+                     f"SELECT :sensor_id, timestamp, value, min_value, max_value FROM {table_name} "
+                     f"WHERE timestamp IS NOT NULL"),
+                {"sensor_id": sensor_id}).rowcount
+            destination_db.execute(text(f"DROP TABLE {table_name}"))
+            create_compatibility_view(destination_db, table_name, sensor_id, timestamp_format)
+            # Everything moved is already in the rollups
+            newest = destination_db.execute(text(f"SELECT max(timestamp) FROM {table_name}")).scalar()
+            set_rollup_progress(destination_db, sensor_id, 0, newest)
+    else:
+        create_readings_table(destination_db, timestamp_format)
+        for sensor_id, table_name in existing_sensor_tables(destination_db, ("view",)):
+            update_rollups(destination_db, sensor_id, table_name, timestamp_format, NARROW)
+            destination_db.execute(text(f"DROP VIEW {table_name}"))
+            prepared_tables.discard(table_name)
+            prepare_topic_table(destination_db, sensor_id, table_name, timestamp_format)
+            moved += destination_db.execute(
+                text(f"INSERT OR IGNORE INTO {table_name} (timestamp, value, min_value, max_value) "
+                     f"SELECT timestamp, value, min_value, max_value FROM readings WHERE sensor_id=:sensor_id "
+                     f"ORDER BY timestamp"),
+                {"sensor_id": sensor_id}).rowcount
+            newest_id = destination_db.execute(text(f"SELECT max(id) FROM {table_name}")).scalar()
+            set_rollup_progress(destination_db, sensor_id, newest_id or 0, None)
+        destination_db.execute(text("DROP TABLE IF EXISTS readings"))
+
+    set_storage_mode(destination_db, storage_mode)
+    prepared_tables.clear()
+    logging.info(f"Converted sorted_data.db from {current_mode} to {storage_mode} storage: {moved} rows "
+                 f"in {time.perf_counter() - started:.1f} s")
+    return True
+
+
+def get_watermarks(destination_db):
+    return dict(destination_db.execute(text("SELECT sensor_id, timestamp FROM watermarks")).fetchall())
+
+
+def update_watermark(destination_db, sensor_id, max_timestamp):
     destination_db.execute(
-        text(f"ALTER TABLE temp_{topic_name} RENAME TO {topic_name};"))
+        text("INSERT INTO watermarks (sensor_id, timestamp) VALUES (:sensor_id, :timestamp) "
+             "ON CONFLICT (sensor_id) DO UPDATE SET timestamp=excluded.timestamp"),
+        {"sensor_id": sensor_id, "timestamp": max_timestamp})
+
+
+def process_topic(destination_db, sensor_id, watermark, timestamp_format, storage_mode=PER_TOPIC):
+    topic_name = registry.get_table_name(sensor_id)
+    prepare_topic_table(destination_db, sensor_id, topic_name, timestamp_format, storage_mode)
+    after = get_window_start(watermark, timestamp_format)
 
+    # The newest row bounds the move, so the watermark is exactly what was moved; on the partitioned view this
+    # reads one index entry per partition instead of rescanning the range
+    max_timestamp = destination_db.execute(
+        text("SELECT timestamp FROM src.temp_records WHERE sensor_id=:sensor_id AND timestamp>:after "
+             "ORDER BY timestamp DESC LIMIT 1"),
+        {"sensor_id": sensor_id, "after": after}).scalar()
+    if max_timestamp is None:
+        return topic_name, None
 
-def update_last_update_time(destination_db, max_timestamp):
-    destination_db.execute(text("UPDATE last_update SET timestamp=:max_timestamp"),
-                           {"max_timestamp": max_timestamp})
+    # Duplicates in the source are rejected by the unique index (or the primary key of readings)
+    inserted = destination_db.execute(
+        text(f"{insert_rows_sql(topic_name, storage_mode)} FROM src.temp_records "
+             f"WHERE sensor_id=:sensor_id AND timestamp>:after AND timestamp<=:until ORDER BY timestamp"),
+        {"sensor_id": sensor_id, "after": after, "until": max_timestamp}).rowcount
 
+    logging.debug(f"{topic_name}: {inserted} new rows after {after}")
 
-def delete_old_records(destination_db):
+    return topic_name, max_timestamp
+
+
+def get_window_start(watermark, timestamp_format):
+    """Lower (exclusive) bound of the rows still to copy for a sensor."""
+    if watermark is None:
+        return timestamps.from_datetime(datetime(1970, 1, 1, tzinfo=timezone.utc), timestamp_format)
+    return timestamps.coerce(watermark, timestamp_format)
+
+
+def delete_old_records(destination_db, timestamp_format, storage_mode=PER_TOPIC):
     tables = destination_db.execute(text("SELECT name FROM sqlite_master WHERE type='table';")).fetchall()
-    cutoff_date = datetime.utcnow() - timedelta(days=180)
-    cutoff_date_str = cutoff_date.strftime('%Y-%m-%d %H:%M:%S')
+    cutoff_date = datetime.now(timezone.utc) - timedelta(days=180)
+    cutoff_date_str = timestamps.from_datetime(cutoff_date, timestamp_format)
+
+    if storage_mode == NARROW:
+        # One primary key range per sensor instead of a scan of the whole readings table
+        for (sensor_id,) in destination_db.execute(text("SELECT id FROM src.sensors")).fetchall():
+            destination_db.execute(
+                text("DELETE FROM readings WHERE sensor_id = :sensor_id AND timestamp < :cutoff_date_str"),
+                {"sensor_id": sensor_id, "cutoff_date_str": cutoff_date_str})
 
     for table in tables:
         table_name = table[0]
-        if table_name != 'last_update':
+        if table_name not in SERVICE_TABLES and not table_name.startswith(rollups.TABLE_PREFIX):
             destination_db.execute(
                 text(f"DELETE FROM {table_name} WHERE timestamp < :cutoff_date_str;"),
                 {"cutoff_date_str": cutoff_date_str})
 
+    for resolution in rollups.EXPIRING_RESOLUTIONS:
+        destination_db.execute(text(f"DELETE FROM {rollups.table_name(resolution)} WHERE bucket < :cutoff"),
+                               {"cutoff": int(cutoff_date.timestamp())})
+
+
+def plan_catch_up(destination_db, watermarks, timestamp_format, chunk):
+    """Split the backlog of every sensor into (sensor_id, after, until] ranges of ``chunk`` length.
+
+    Returns the ranges, the newest timestamp per sensor and the oldest pending timestamp.
+    """
+    ranges = []
+    ends = {}
+    oldest = None
+    for (sensor_id,) in destination_db.execute(text("SELECT id FROM src.sensors")).fetchall():
+        after = get_window_start(watermarks.get(sensor_id), timestamp_format)
+        first, last = destination_db.execute(
+            text("SELECT min(timestamp), max(timestamp) FROM src.temp_records "
+                 "WHERE sensor_id=:sensor_id AND timestamp>:after"),
+            {"sensor_id": sensor_id, "after": after}).fetchone()
+        if last is None:
+            continue
+
+        ends[sensor_id] = last
+        bound = timestamps.to_datetime(first)
+        end = timestamps.to_datetime(last)
+        if oldest is None or bound < oldest:
+            oldest = bound
+        while True:
+            bound += chunk
+            if bound >= end:
+                ranges.append((sensor_id, after, last))
+                break
+            until = timestamps.from_datetime(bound, timestamp_format)
+            ranges.append((sensor_id, after, until))
+            after = until
+    return ranges, ends, oldest
+
+
+staging_conn = None
+
+
+def init_staging_worker(source_path):
+    global staging_conn
+    path = os.path.join(staging_dir, f"staging_{os.getpid()}.db")
+    staging_conn = sqlite3.connect(path, isolation_level=None)
+    # Scratch file: it is thrown away if the catch-up does not finish
+    staging_conn.execute("PRAGMA journal_mode=OFF")
+    staging_conn.execute("PRAGMA synchronous=OFF")
+    staging_conn.execute("ATTACH DATABASE ? AS src", (source_path,))
+    staging_conn.execute("CREATE TABLE IF NOT EXISTS staging (sensor_id INTEGER, timestamp, value REAL, "
+                         "min_value REAL, max_value REAL, PRIMARY KEY (sensor_id, timestamp)) WITHOUT ROWID")
+
+
+def copy_range_to_staging(time_range):
+    started = time.perf_counter()
+    rows = staging_conn.execute(
+        "INSERT OR IGNORE INTO staging (sensor_id, timestamp, value, min_value, max_value) "
+        "SELECT sensor_id, timestamp, value, min_value, max_value FROM src.temp_records "
+        "WHERE sensor_id=? AND timestamp>? AND timestamp<=?", time_range).rowcount
+    return time_range[0], rows, time.perf_counter() - started
+
+
+def merge_staging(destination_db, timestamp_format, storage_mode=PER_TOPIC):
+    merged = 0
+    for path in sorted(glob.glob(os.path.join(staging_dir, "staging_*.db"))):
+        destination_db.connection.execute("ATTACH DATABASE ? AS stg", (path,))
+        try:
+            with destination_db.begin():
+                sensor_ids = destination_db.execute(text("SELECT DISTINCT sensor_id FROM stg.staging")).fetchall()
+                for (sensor_id,) in sensor_ids:
+                    topic_name = registry.get_table_name(sensor_id)
+                    prepare_topic_table(destination_db, sensor_id, topic_name, timestamp_format, storage_mode)
+                    merged += destination_db.execute(
+                        text(f"{insert_rows_sql(topic_name, storage_mode)} "
+                             f"FROM stg.staging WHERE sensor_id=:sensor_id ORDER BY timestamp"),
+                        {"sensor_id": sensor_id}).rowcount
+        finally:
+            destination_db.connection.execute("DETACH DATABASE stg")
+        logging.info(f"Catch-up: merged {os.path.basename(path)}, {merged} rows so far")
+    return merged
+
+
+def clear_staging():
+    for path in glob.glob(os.path.join(staging_dir, "staging_*.db*")):
+        os.remove(path)
+
+
+def catch_up(force=False, workers=None, chunk=timedelta(hours=24)):
+    """Copy the backlog with a process pool, each worker into its own staging file, then merge the files
+    and move the watermarks. Returns False when the backlog is small enough for the regular cycle."""
+    with lock:
+        with source_engine.connect() as source_db:
+            with destination_engine.connect() as destination_db:
+                timestamp_format = timestamps.get_format(source_db.connection)
+                with destination_db.begin():
+                    storage_mode = get_storage_mode(destination_db)
+                    check_and_create_watermarks_table(destination_db)
+                    check_and_create_rollup_tables(destination_db)
+                    check_and_create_latest_readings_table(destination_db)
+                    watermarks = get_watermarks(destination_db)
+                    ranges, ends, oldest = plan_catch_up(destination_db, watermarks, timestamp_format, chunk)
+
+                if not ranges or (not force and datetime.now(timezone.utc) - oldest < CATCH_UP_LAG):
+                    return False
+
+                logging.info(f"Catch-up: {len(ranges)} ranges for {len(ends)} sensors since {oldest.isoformat()}")
+                os.makedirs(staging_dir, exist_ok=True)
+                clear_staging()
+                started = time.perf_counter()
+                copied = 0
+                with multiprocessing.Pool(workers, initializer=init_staging_worker,
+                                          initargs=(os.path.abspath(source_db_path),)) as pool:
+                    for done, (sensor_id, rows, elapsed) in enumerate(
+                            pool.imap_unordered(copy_range_to_staging, ranges), 1):
+                        copied += rows
+                        total_elapsed = time.perf_counter() - started
+                        logging.info(f"Catch-up: {done}/{len(ranges)} ranges ({done * 100 // len(ranges)}%), "
+                                     f"{copied} rows, {copied / max(total_elapsed, 1e-9):.0f} rows/s")
+
+                merged = merge_staging(destination_db, timestamp_format, storage_mode)
+                # Rollups go last: staging files hold interleaved time ranges and merge in any order
+                with destination_db.begin():
+                    for sensor_id, end in ends.items():
+                        topic_name = registry.get_table_name(sensor_id)
+                        update_watermark(destination_db, sensor_id, end)
+                        update_latest_reading(destination_db, sensor_id, topic_name)
+                        update_rollups(destination_db, sensor_id, topic_name, timestamp_format, storage_mode)
+                clear_staging()
+
+                elapsed = time.perf_counter() - started
+                logging.info(f"Catch-up finished: {copied} rows staged, {merged} new rows in {elapsed:.1f} s "
+                             f"({copied / max(elapsed, 1e-9):.0f} rows/s)")
+                return True
+
+
+def switch_storage(storage_mode):
+    with lock:
+        with source_engine.connect() as source_db:
+            with destination_engine.connect() as destination_db:
+                timestamp_format = timestamps.get_format(source_db.connection)
+                with destination_db.begin():
+                    return convert_storage(destination_db, storage_mode, timestamp_format)
+
+
+def main(catch_up_only=False, workers=None, chunk_hours=24, storage_mode=None):
+    if storage_mode is not None:
+        switch_storage(storage_mode)
+
+    try:
+        catch_up(force=catch_up_only, workers=workers, chunk=timedelta(hours=chunk_hours))
+    except Exception as e:
+        logging.exception("Catch-up failed, continuing with regular cycles")
+    if catch_up_only:
+        return
 
-def main():
     while True:
         try:
             with lock:
@@ -161,10 +563,13 @@ def main():
                         update_and_sort_data(destination_db, source_db)
                         logging.debug("Finished updating and sorting data.")
                         destination_db.connection.execute("PRAGMA wal_checkpoint;")
-                        delete_old_records(destination_db)
+                        delete_old_records(destination_db, timestamps.get_format(source_db.connection),
+                                           get_storage_mode(destination_db))
                         logging.debug("Finished old records deletion.")
         except Exception as e:
             logging.exception("Unexpected error occurred")
+            # The sorted database may have been replaced; check the sensor tables again next cycle
+            prepared_tables.clear()
         try:
             time.sleep(60)
         except KeyboardInterrupt:
@@ -172,4 +577,14 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Copies sensor data into per-sensor tables of sorted_data.db")
+    parser.add_argument("--catch-up", action="store_true",
+                        help="copy the whole backlog with a process pool and exit")
+    parser.add_argument("--workers", type=int, default=None, help="catch-up processes (default: CPU count)")
+    parser.add_argument("--chunk-hours", type=float, default=24, help="time range copied by one catch-up task")
+    parser.add_argument("--storage", choices=STORAGE_MODES,
+                        help="convert sorted_data.db to this storage layout; the choice is kept in its meta table")
+    args = parser.parse_args()
+    if args.catch_up or args.storage:
+        logging.getLogger().addHandler(logging.StreamHandler())
+    main(args.catch_up, args.workers, args.chunk_hours, args.storage)
@@ -0,0 +1,199 @@
+import logging
+from contextlib import contextmanager
+
+import timestamps
+from partitioning import LEGACY_PARTITION, TEMP_RECORDS_COLUMNS, create_partitions_table, rebuild_view
+from sensor_registry import create_sensors_table
+
+COPY_BATCH_SIZE = 50000
+
+
+@contextmanager
+def transaction(conn):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    else:
+        conn.execute("COMMIT")
+
+
+def get_columns(conn, table_name):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")]
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, migrations, label, progress=None):
+    """Apply every migration newer than the database's ``user_version``.
+
+    ``conn`` must be in autocommit mode (``isolation_level=None``); each migration manages its own
+    transactions and must be safe to re-run if the process dies before the version is recorded.
+    """
+    if progress is None:
+        progress = logging.info
+
+    current_version = get_schema_version(conn)
+    pending = [migration for migration in migrations if migration[0] > current_version]
+    if not pending:
+        return current_version
+
+    for version, description, upgrade in pending:
+        progress(f"[{label}] Applying migration {version}/{migrations[-1][0]}: {description}")
+        upgrade(conn, progress)
+        conn.execute(f"PRAGMA user_version = {int(version)}")
+        current_version = version
+
+    progress(f"[{label}] Schema is at version {current_version}")
+    return current_version
+
+
+def copy_in_batches(conn, source, destination, columns, select_list, progress, label, where="1",
+                    batch_size=COPY_BATCH_SIZE):
+    """Copy ``source`` into ``destination`` by rowid in short transactions, resuming after a restart."""
+    total = conn.execute(f"SELECT count(*) FROM {source}").fetchone()[0]
+    last_rowid = conn.execute(f"SELECT COALESCE(max(id), 0) FROM {destination}").fetchone()[0]
+    copied = conn.execute(f"SELECT count(*) FROM {destination}").fetchone()[0]
+    while True:
+        with transaction(conn):
+            upper = conn.execute(
+                f"SELECT max(rowid) FROM (SELECT rowid FROM {source} WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+                (last_rowid, batch_size)
+            ).fetchone()[0]
+            if upper is None:
+                break
+            cursor = conn.execute(
+                f"INSERT INTO {destination} ({columns}) SELECT {select_list} FROM {source} "
+                f"WHERE rowid > ? AND rowid <= ? AND ({where})",
+                (last_rowid, upper)
+            )
+        copied += max(cursor.rowcount, 0)
+        last_rowid = upper
+        progress(f"[{label}] {copied}/{total} rows copied ({copied * 100 // max(total, 1)}%)")
+
+
+# sensors_data.db
+AGGREGATE_COLUMNS = ("sample_count", "min_value", "max_value", "sum_value", "first_value", "last_value")
+
+
+def create_temp_records_table(conn, table_name="temp_records", timestamp_type="TEXT"):
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {table_name} ("
+        "id INTEGER PRIMARY KEY,"
+        f"timestamp {timestamp_type} NOT NULL,"
+        "sensor_id INTEGER NOT NULL,"
+        "value REAL NOT NULL,"
+        "sample_count INTEGER NOT NULL DEFAULT 1,"
+        "min_value REAL,"
+        "max_value REAL,"
+        "sum_value REAL,"
+        "first_value REAL,"
+        "last_value REAL)"
+    )
+
+
+def _create_base_tables(conn, progress):
+    with transaction(conn):
+        create_sensors_table(conn)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS temp_records (timestamp, sensor_id, value, sample_count, "
+            "min_value, max_value, sum_value, first_value, last_value)"
+        )
+
+
+def _add_aggregates_and_sensor_ids(conn, progress):
+    # Databases created before per-window aggregates only have (timestamp, topic, value)
+    columns = get_columns(conn, "temp_records")
+    with transaction(conn):
+        for column in ("sensor_id",) + AGGREGATE_COLUMNS:
+            if column not in columns:
+                conn.execute(f"ALTER TABLE temp_records ADD COLUMN {column}")
+        if "topic" in columns:
+            conn.execute(
+                "INSERT OR IGNORE INTO sensors (topic) "
+                "SELECT DISTINCT topic FROM temp_records WHERE sensor_id IS NULL AND topic IS NOT NULL"
+            )
+            conn.execute(
+                "UPDATE temp_records SET sensor_id = (SELECT id FROM sensors WHERE sensors.topic = temp_records.topic) "
+                "WHERE sensor_id IS NULL AND topic IS NOT NULL"
+            )
+
+
+def _type_temp_records(conn, progress):
+    if "id" in get_columns(conn, "temp_records"):
+        return
+
+    create_temp_records_table(conn, "temp_records_typed", timestamps.column_type(timestamps.get_format(conn)))
+    copy_in_batches(
+        conn, "temp_records", "temp_records_typed", TEMP_RECORDS_COLUMNS,
+        "rowid, timestamp, sensor_id, value, COALESCE(sample_count, 1), COALESCE(min_value, value), "
+        "COALESCE(max_value, value), COALESCE(sum_value, value), COALESCE(first_value, value), "
+        "COALESCE(last_value, value)",
+        progress, "temp_records",
+        # Rows that could not be attributed to a sensor are not carried over
+        where="sensor_id IS NOT NULL AND value IS NOT NULL"
+    )
+    with transaction(conn):
+        conn.execute("DROP TABLE temp_records")
+        conn.execute("ALTER TABLE temp_records_typed RENAME TO temp_records")
+
+
+def _index_temp_records(conn, progress):
+    with transaction(conn):
+        progress("[temp_records] Building (sensor_id, timestamp) covering index")
+        conn.execute("CREATE INDEX IF NOT EXISTS temp_records_sensor_timestamp "
+                     "ON temp_records (sensor_id, timestamp, value)")
+        progress("[temp_records] Building timestamp index")
+        conn.execute("CREATE INDEX IF NOT EXISTS temp_records_timestamp ON temp_records (timestamp)")
+
+
+def _partition_temp_records(conn, progress):
+    table_type = conn.execute("SELECT type FROM sqlite_master WHERE name = 'temp_records'").fetchone()
+    if table_type is not None and table_type[0] == "view":
+        return
+
+    timestamp_format = timestamps.get_format(conn)
+    with transaction(conn):
+        create_partitions_table(conn)
+        start_time, end_time = conn.execute("SELECT min(timestamp), max(timestamp) FROM temp_records").fetchone()
+        if start_time is None:
+            conn.execute("DROP TABLE temp_records")
+        else:
+            # Existing history becomes one partition that ends at its newest row, so new rows get partitions of
+            # their own. Retention deletes its expired rows until all of it has expired and it is dropped
+            progress(f"[temp_records] Keeping existing rows as partition {LEGACY_PARTITION}")
+            conn.execute(f"ALTER TABLE temp_records RENAME TO {LEGACY_PARTITION}")
+            conn.execute("INSERT OR REPLACE INTO partitions (name, start_time, end_time) VALUES (?, ?, ?)",
+                         (LEGACY_PARTITION, start_time, timestamps.coerce(end_time, timestamp_format)))
+        rebuild_view(conn)
+
+
+SENSORS_DATA_MIGRATIONS = [
+    (1, "create sensors and temp_records", _create_base_tables),
+    (2, "add window aggregates and sensor ids to temp_records", _add_aggregates_and_sensor_ids),
+    (3, "rebuild temp_records with typed columns", _type_temp_records),
+    (4, "index temp_records by sensor and time", _index_temp_records),
+    (5, "split temp_records into time partitions behind a view", _partition_temp_records),
+]
+
+
+# user_settings.db
+
+def _add_critical_ranges(conn, progress):
+    # Перенесено из devtools/add_db_fields.py
+    if "ranges" not in [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]:
+        return
+    columns = get_columns(conn, "ranges")
+    with transaction(conn):
+        for column in ("critical_overheat", "critical_overcool"):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE ranges ADD COLUMN {column} INTEGER DEFAULT 0")
+
+
+USER_SETTINGS_MIGRATIONS = [
+    (1, "add critical thresholds to ranges", _add_critical_ranges),
+]
@@ -0,0 +1,104 @@
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import timestamps
+from partitioning import rebuild_view
+
+# Перед запуском остановите AT_process_monitor: конвертация перестраивает таблицы
+sensors_db_path = '../instance/sensors_data.db'
+sorted_db_path = '../instance/sorted_data.db'
+incidents_db_path = '../instance/incidents.db'
+
+
+def rebuild_table(conn, table_name, column, target):
+    """Пересоздаёт таблицу с новым типом столбца времени и переносит данные с конвертацией."""
+    columns = conn.execute(f"PRAGMA table_info({table_name})").fetchall()
+    if not columns:
+        return
+    indexes = [row[0] for row in conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL", (table_name,))]
+    table_sql = conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table_name,)).fetchone()[0]
+    primary_key = [name for _, name, _, _, _, pk in sorted(columns, key=lambda row: row[5]) if pk]
+
+    definitions = []
+    for _, name, column_type, not_null, _, pk in columns:
+        if name == column:
+            column_type = timestamps.column_type(target)
+        definition = f"{name} {column_type}".strip()
+        if pk and len(primary_key) == 1:
+            definition += " PRIMARY KEY"
+        if not_null:
+            definition += " NOT NULL"
+        definitions.append(definition)
+    # Составной ключ (readings, rollup-таблицы) задаётся отдельно и сохраняет WITHOUT ROWID
+    if len(primary_key) > 1:
+        definitions.append(f"PRIMARY KEY ({', '.join(primary_key)})")
+    options = " WITHOUT ROWID" if "WITHOUT ROWID" in table_sql.upper() else ""
+
+    names = ", ".join(name for _, name, *_ in columns)
+    select_list = ", ".join(f"convert_timestamp({name})" if name == column else name for _, name, *_ in columns)
+
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute(f"CREATE TABLE {table_name}_converted ({', '.join(definitions)}){options}")
+    conn.execute(f"INSERT INTO {table_name}_converted ({names}) SELECT {select_list} FROM {table_name}")
+    conn.execute(f"DROP TABLE {table_name}")
+    conn.execute(f"ALTER TABLE {table_name}_converted RENAME TO {table_name}")
+    for index_sql in indexes:
+        conn.execute(index_sql)
+    conn.execute("COMMIT")
+    print(f'{table_name}: converted')
+
+
+def connect(db_path, target):
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.create_function('convert_timestamp', 1, lambda value: timestamps.coerce(value, target), deterministic=True)
+    return conn
+
+
+def table_names(conn):
+    return [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+
+
+target_format = sys.argv[1] if len(sys.argv) > 1 else timestamps.EPOCH_MS
+if target_format not in timestamps.FORMATS:
+    sys.exit(f'Usage: python convert_timestamps.py [{"|".join(timestamps.FORMATS)}]')
+
+sensors_conn = connect(sensors_db_path, target_format)
+current_format = timestamps.get_format(sensors_conn)
+if current_format == target_format:
+    sys.exit(f'Databases already store {target_format} timestamps')
+
+# temp_records — представление над таблицами-секциями, конвертируются сами секции и их границы
+sensors_conn.execute("DROP VIEW IF EXISTS temp_records")
+for (partition_name,) in sensors_conn.execute("SELECT name FROM partitions").fetchall():
+    rebuild_table(sensors_conn, partition_name, 'timestamp', target_format)
+rebuild_table(sensors_conn, 'partitions', 'start_time', target_format)
+rebuild_table(sensors_conn, 'partitions', 'end_time', target_format)
+
+if os.path.exists(sorted_db_path):
+    sorted_conn = connect(sorted_db_path, target_format)
+    # Представления датчиков над readings (узкий режим) data_sorter создаст заново уже с новым форматом
+    for (view_name,) in sorted_conn.execute("SELECT name FROM sqlite_master WHERE type='view'").fetchall():
+        sorted_conn.execute(f"DROP VIEW {view_name}")
+    rebuild_table(sorted_conn, 'rollup_progress', 'last_timestamp', target_format)
+    for name in table_names(sorted_conn):
+        if 'timestamp' in [row[1] for row in sorted_conn.execute(f"PRAGMA table_info({name})")]:
+            rebuild_table(sorted_conn, name, 'timestamp', target_format)
+    sorted_conn.close()
+
+if os.path.exists(incidents_db_path):
+    incidents_conn = connect(incidents_db_path, target_format)
+    rebuild_table(incidents_conn, 'incidents', 'datetime', target_format)
+    rebuild_table(incidents_conn, 'last_processed', 'timestamp', target_format)
+    rebuild_table(incidents_conn, 'states', 'since', target_format)
+    incidents_conn.close()
+
+rebuild_view(sensors_conn)
+
+# Формат записывается последним: пока он не изменён, остальные процессы продолжают работать со старым
+timestamps.set_format(sensors_conn, target_format)
+sensors_conn.close()
+print(f'Converted {current_format} -> {target_format}')
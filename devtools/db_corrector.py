@@ -1,11 +1,25 @@
+import os
+import sys
+
 from sqlalchemy import create_engine, text
 
+sys.path.insert(0, os.path.abspath('..'))
+
+import timestamps
+
 destination_db_path = '../instance/sorted_data.db'
+# Формат хранения меток времени записан в sensors_data.db
+sensors_db_path = '../instance/sensors_data.db'
 destination_engine = create_engine(f'sqlite:///{destination_db_path}', echo=False)
 
-def set_last_update_time(destination_db):
-    destination_db.execute(text("UPDATE last_update SET timestamp='2023-07-17T00:00:00+00:00'"))
+REWIND_TO = '2023-07-17T00:00:00+00:00'
+
+def set_last_update_time(destination_db, timestamp_format):
+    # Откатывает все датчики, чтобы data_sorter заново скопировал данные начиная с этой даты
+    rewind_to = timestamps.coerce(REWIND_TO, timestamp_format)
+    destination_db.execute(text("UPDATE watermarks SET timestamp=:rewind_to WHERE timestamp > :rewind_to"),
+                           {"rewind_to": rewind_to})
 
 with destination_engine.connect() as destination_db:
     with destination_db.begin():
-        set_last_update_time(destination_db)
+        set_last_update_time(destination_db, timestamps.read_format(sensors_db_path))
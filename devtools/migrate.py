@@ -0,0 +1,28 @@
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.abspath('..'))
+
+from db_migrations import SENSORS_DATA_MIGRATIONS, USER_SETTINGS_MIGRATIONS, get_schema_version, migrate
+
+databases = {
+    '../instance/sensors_data.db': SENSORS_DATA_MIGRATIONS,
+    '../instance/user_settings.db': USER_SETTINGS_MIGRATIONS,
+}
+
+# Без аргументов только показывает версии схем, с --apply применяет недостающие миграции
+apply = '--apply' in sys.argv[1:]
+
+for db_file, migrations in databases.items():
+    if not os.path.exists(db_file):
+        print(f'{db_file}: not found')
+        continue
+
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    version = get_schema_version(conn)
+    latest = migrations[-1][0]
+    print(f'{db_file}: schema version {version}, latest {latest}')
+    if apply and version < latest:
+        migrate(conn, migrations, db_file, progress=print)
+    conn.close()
@@ -0,0 +1,94 @@
+import json
+import logging
+import os
+import select
+import socket
+
+import timestamps
+
+# Channels: the collector announces flushed rows of temp_records, the detector announces new incidents
+RECORDS = "records"
+INCIDENTS = "incidents"
+
+SOCKET_DIR = "instance"
+MAX_EVENT_SIZE = 4096
+
+
+def socket_path(channel):
+    return os.path.join(SOCKET_DIR, f"{channel}.sock")
+
+
+class Publisher:
+    """Sends events of one channel to its subscriber as Unix datagrams.
+
+    Publishing never blocks and never fails the caller: when nobody is subscribed, or the subscriber's
+    queue is full, the event is counted as dropped and the subscriber finds the data with its fallback poll.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.path = socket_path(channel)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.published = 0
+        self.dropped = 0
+
+    def publish(self, origin_ms=None, **fields):
+        """``origin_ms`` is when the data behind the event was first written; consumers pass it on so the
+        last one can report end-to-end latency."""
+        published_ms = timestamps.now_ms()
+        event = dict(fields, origin_ms=origin_ms or published_ms, published_ms=published_ms)
+        try:
+            self.sock.sendto(json.dumps(event).encode(), self.path)
+            self.published += 1
+        except OSError as e:
+            # No subscriber (ENOENT, ECONNREFUSED) or its queue is full (EAGAIN)
+            self.dropped += 1
+            logging.debug(f"Event on '{self.channel}' dropped: {e}")
+
+    def close(self):
+        self.sock.close()
+
+
+class Subscriber:
+    """Receives the events of one channel. Only one process may subscribe to a channel."""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.path = socket_path(channel)
+        if os.path.exists(self.path):
+            # Left behind by a previous run that did not shut down cleanly
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.setblocking(False)
+        self.received = 0
+
+    def wait(self, timeout):
+        """Events received within ``timeout`` seconds, oldest first; an empty list means the caller should
+        poll anyway."""
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        if not readable:
+            return []
+
+        events = []
+        while True:
+            try:
+                payload = self.sock.recv(MAX_EVENT_SIZE)
+            except BlockingIOError:
+                break
+            try:
+                events.append(json.loads(payload))
+            except ValueError:
+                logging.warning(f"Ignoring a malformed event on '{self.channel}'")
+        self.received += len(events)
+        return events
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def latency_ms(event, field="published_ms"):
+    return timestamps.now_ms() - event[field]
@@ -1,10 +1,15 @@
+import re
 import sqlite3
 import asyncio
-from datetime import datetime, timedelta
+from collections import deque
+from datetime import timedelta
 from aiogram import Bot
-import time
+from aiogram.utils.exceptions import RetryAfter
 import logging
 
+import event_bus
+import timestamps
+
 logging.basicConfig(filename='instance/evnot_log', level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -41,25 +46,34 @@ logging.info('Initialized Telegram bots.')
 loop = asyncio.new_event_loop()
 asyncio.set_event_loop(loop)
 
-previous_messages = {}
-sent_incident_ids = set()
+# Новые инциденты приходят событием от incident_detector; опрос таблицы — запасной путь на случай потерянного
+# события, поэтому он идёт с прежним интервалом
+FALLBACK_POLL_INTERVAL = 10
+incident_events = event_bus.Subscriber(event_bus.INCIDENTS)
 
 
-def get_previous_incident_type(current_id, tab_id, sensor_name):
-    while current_id > 0:
-        current_id -= 1
-        cur_incidents.execute("SELECT event, tab_id, sensor FROM incidents WHERE id=?", (current_id,))
-        row = cur_incidents.fetchone()
+# Последний перегрев или переохлаждение каждого датчика: (tab_id, sensor) -> (id, event),
+# обновляется по мере того, как инциденты ставятся в очередь
+open_incidents = {}
+
 
-        if not row:
-            continue
+def track_open_incident(incident_id, event, tab_id, sensor_name):
+    if event in ['Перегрев', 'Переохлаждение']:
+        open_incidents[(tab_id, sensor_name)] = (incident_id, event)
 
-        event, prev_tab_id, prev_sensor = row
 
-        if prev_tab_id == tab_id and prev_sensor == sensor_name and event in ['Перегрев', 'Переохлаждение']:
-            return event
+def get_previous_incident_type(current_id, tab_id, sensor_name):
+    open_incident = open_incidents.get((tab_id, sensor_name))
+    # Инциденты ставятся в очередь по порядку id, поэтому между запомненным и текущим другого перегрева нет
+    if open_incident and open_incident[0] < current_id:
+        return open_incident[1]
 
-    return None
+    # Инцидент старше карты (до перезапуска или уже перекрыт новым) — один запрос по индексу incidents_sensor
+    cur_incidents.execute("SELECT event FROM incidents WHERE sensor = ? AND tab_id = ? AND id < ? "
+                          "AND event IN ('Перегрев', 'Переохлаждение') ORDER BY id DESC LIMIT 1",
+                          (sensor_name, tab_id, current_id))
+    row = cur_incidents.fetchone()
+    return row[0] if row else None
 
 
 def convert_tab_id(tab_id):
@@ -68,6 +82,19 @@ def convert_tab_id(tab_id):
     return tab_name
 
 
+# Длительность хранится как str(timedelta): '0:10:00', '0:10:00.250000', '2 days, 1:00:00'
+DURATION_PATTERN = re.compile(r'(?:(-?\d+) days?, )?(\d+):(\d{2}):(\d{2}(?:\.\d+)?)')
+
+
+def parse_duration(duration):
+    """Длительность в целых секундах (полсекунды округляются вверх) или None, если её нет или не разобрать."""
+    match = DURATION_PATTERN.fullmatch(duration or '')
+    if not match:
+        return None
+    days, hours, minutes, seconds = match.groups()
+    return int(int(days or 0) * 86400 + int(hours) * 3600 + int(minutes) * 60 + float(seconds) + 0.5)
+
+
 def format_message(incident):
     tab_name = convert_tab_id(incident[3])
     prev_incident_type = get_previous_incident_type(incident[0], incident[3], incident[4]) if incident[
@@ -82,25 +109,18 @@ def format_message(incident):
     }.get(incident[2], '🚨')
 
     datetime_str = incident[1]
-    datetime_obj = datetime.fromisoformat(datetime_str.replace("Z", "+00:00")) + timedelta(hours=3)
+    datetime_obj = timestamps.to_datetime(datetime_str) + timedelta(hours=3)
     datetime_corrected_str = datetime_obj.strftime('%d.%m.%Y в %H:%M:%S')
 
+    total_seconds = None
     if incident[2] == 'Возврат в норму' and prev_incident_type:
-        if 'day' in incident[7]:  # Если присутствует день
-            days_str, time_str = incident[7].split(' day, ')
-            days = int(days_str)
-            hours, minutes, rest = time_str.split(':')
-            logging.info(f"Downtime exceeded a day. Total days: {days}.")
-        else:
-            days = 0
-            hours, minutes, rest = incident[7].split(':')
-
-        seconds, milliseconds = map(int, rest.split('.'))
-        total_seconds = days * 86400 + int(hours) * 3600 + int(minutes) * 60 + seconds
-
-        if milliseconds >= 500:
-            total_seconds += 1
+        total_seconds = parse_duration(incident[7])
+        if total_seconds is None:
+            logging.warning(f"Incident {incident[0]} has no usable duration: {incident[7]!r}")
+        elif total_seconds >= 86400:
+            logging.info(f"Downtime exceeded a day. Total days: {total_seconds // 86400}.")
 
+    if total_seconds is not None:
         downtime = str(timedelta(seconds=total_seconds))
         logging.info(f"Total downtime in seconds: {total_seconds}.")
 
@@ -116,83 +136,314 @@ def format_message(incident):
     return message
 
 
-async def send_incident(incident):
-    incident_id = incident[0]
+class TokenBucket:
+    """Ограничитель частоты: не больше ``capacity`` сообщений подряд, дальше ``rate`` сообщений в секунду."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = loop.time()
+        self.paused_until = 0
 
-    if incident_id in sent_incident_ids:
+    def wait_time(self):
+        now = loop.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(self.paused_until - now, (1 - self.tokens) / self.rate, 0)
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        # Ответ 429: Telegram сам говорит, сколько ждать
+        self.paused_until = max(self.paused_until, loop.time() + seconds)
+
+
+async def acquire(*buckets):
+    # Жетоны берутся из всех ограничителей сразу, иначе жетон одного сгорал бы, пока ждём другой
+    while True:
+        wait = max(bucket.wait_time() for bucket in buckets)
+        if wait <= 0:
+            for bucket in buckets:
+                bucket.take()
+            return
+        await asyncio.sleep(wait)
+
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота, 1 в секунду в личный чат и 20 в минуту в группу
+BOT_RATE = 30
+PRIVATE_CHAT_RATE = 1
+GROUP_CHAT_RATE = 20 / 60
+MAX_SEND_ATTEMPTS = 5
+bot_buckets = {}
+chat_buckets = {}
+# Задержки доставки (от времени показания до ответа Telegram) последних сообщений, для процентилей
+delivery_latencies = deque(maxlen=1000)
+
+
+def bot_name(bot):
+    return bot._token.split(':')[0]
+
+
+def get_bucket(buckets, key, rate):
+    bucket = buckets.get(key)
+    if bucket is None:
+        bucket = buckets[key] = TokenBucket(rate)
+    return bucket
+
+
+async def send_limited(bot, chat_id, message, reply_to_id=None):
+    bot_bucket = get_bucket(bot_buckets, bot_name(bot), BOT_RATE)
+    # У групп и каналов отрицательный id
+    chat_rate = GROUP_CHAT_RATE if str(chat_id).startswith('-') else PRIVATE_CHAT_RATE
+    chat_bucket = get_bucket(chat_buckets, (bot_name(bot), chat_id), chat_rate)
+    for attempt in range(1, MAX_SEND_ATTEMPTS + 1):
+        await acquire(bot_bucket, chat_bucket)
+        try:
+            return await bot.send_message(chat_id, message, parse_mode='HTML', reply_to_message_id=reply_to_id)
+        except RetryAfter as e:
+            if attempt == MAX_SEND_ATTEMPTS:
+                raise
+            logging.warning(f"Flood control for chat_id {chat_id} using bot {bot_name(bot)}, "
+                            f"retrying in {e.timeout} s (attempt {attempt})")
+            # Ограничение Telegram действует на весь бот, а не только на этот чат
+            bot_bucket.pause(e.timeout)
+            chat_bucket.pause(e.timeout)
+
+
+# Очередь доставки: строка на каждую пару (инцидент, бот, чат) в incidents.db, статусы переживают перезапуск
+PENDING, SENT, FAILED = 'pending', 'sent', 'failed'
+DELIVERY_BATCH = 500
+MAX_DELIVERY_ATTEMPTS = 5
+RETRY_DELAY_MS = 10000
+
+
+def create_outbox():
+    # Детектор пишет инциденты одновременно с нами
+    cur_incidents.execute("PRAGMA journal_mode=WAL")
+    cur_incidents.execute(
+        "CREATE TABLE IF NOT EXISTS deliveries ("
+        "incident_id INTEGER NOT NULL,"
+        "bot TEXT NOT NULL,"
+        "chat_id TEXT NOT NULL,"
+        f"status TEXT NOT NULL DEFAULT '{PENDING}',"
+        "attempts INTEGER NOT NULL DEFAULT 0,"
+        "next_attempt_ms INTEGER NOT NULL DEFAULT 0,"
+        "message_id INTEGER,"
+        "PRIMARY KEY (incident_id, bot, chat_id)) WITHOUT ROWID"
+    )
+    cur_incidents.execute(f"CREATE INDEX IF NOT EXISTS deliveries_pending ON deliveries (bot, chat_id, incident_id) "
+                          f"WHERE status = '{PENDING}'")
+    # Тот же индекс создаёт incident_detector; нужен, если детектор ещё не обновил базу
+    cur_incidents.execute("CREATE INDEX IF NOT EXISTS incidents_sensor ON incidents (sensor, tab_id, id)")
+    # Последний инцидент, уже разложенный по получателям
+    cur_incidents.execute("CREATE TABLE IF NOT EXISTS outbox_checkpoint ("
+                          "id INTEGER PRIMARY KEY CHECK (id = 1), last_incident_id INTEGER NOT NULL)")
+    # При первом запуске с очередью старые инциденты считаем уже отправленными
+    cur_incidents.execute("INSERT OR IGNORE INTO outbox_checkpoint (id, last_incident_id) "
+                          "SELECT 1, COALESCE(max(id), 0) FROM incidents")
+
+    # Боты и чаты читаются при старте: доставки удалённым получателям больше не выполнятся
+    recipients = [(bot_name(bot), chat_id[0]) for bot in bots for chat_id in chat_ids]
+    cur_incidents.execute("SELECT DISTINCT bot, chat_id FROM deliveries WHERE status = ?", (PENDING,))
+    removed = [recipient for recipient in cur_incidents.fetchall() if recipient not in recipients]
+    for bot, chat_id in removed:
+        cur_incidents.execute("UPDATE deliveries SET status = ? WHERE status = ? AND bot = ? AND chat_id = ?",
+                              (FAILED, PENDING, bot, chat_id))
+        logging.warning(f"Bot {bot} or chat_id {chat_id} is no longer configured, "
+                        f"{cur_incidents.rowcount} pending deliveries marked as failed.")
+    conn_incidents.commit()
+
+
+def enqueue_incidents():
+    cur_incidents.execute("SELECT last_incident_id FROM outbox_checkpoint")
+    last_incident_id = cur_incidents.fetchone()[0]
+    enqueued = 0
+    while True:
+        cur_incidents.execute("SELECT id, event, tab_id, sensor FROM incidents WHERE id > ? ORDER BY id LIMIT ?",
+                              (last_incident_id, DELIVERY_BATCH))
+        incidents = cur_incidents.fetchall()
+        if not incidents:
+            return enqueued
+        for incident in incidents:
+            track_open_incident(*incident)
+        incident_ids = [incident[0] for incident in incidents]
+        # Доставки и отметка записываются одной транзакцией: после сбоя пачка не потеряется и не задвоится
+        cur_incidents.executemany(
+            "INSERT OR IGNORE INTO deliveries (incident_id, bot, chat_id) VALUES (?, ?, ?)",
+            [(incident_id, bot_name(bot), chat_id[0])
+             for incident_id in incident_ids for bot in bots for chat_id in chat_ids])
+        last_incident_id = incident_ids[-1]
+        cur_incidents.execute("UPDATE outbox_checkpoint SET last_incident_id = ?", (last_incident_id,))
+        conn_incidents.commit()
+        enqueued += len(incident_ids)
+
+
+def claim_deliveries():
+    # Доставка ждёт, пока в её чате не уйдут все более ранние, чтобы не нарушить порядок сообщений
+    cur_incidents.execute(
+        "SELECT incidents.id, incidents.datetime, incidents.event, incidents.tab_id, incidents.sensor, "
+        "incidents.value, incidents.peak, incidents.duration, d.bot, d.chat_id, d.attempts "
+        "FROM deliveries AS d JOIN incidents ON incidents.id = d.incident_id "
+        "WHERE d.status = :pending AND d.next_attempt_ms <= :now AND NOT EXISTS ("
+        "SELECT 1 FROM deliveries AS earlier WHERE earlier.status = :pending AND earlier.bot = d.bot "
+        "AND earlier.chat_id = d.chat_id AND earlier.incident_id < d.incident_id "
+        "AND earlier.next_attempt_ms > :now) "
+        "ORDER BY d.incident_id LIMIT :limit",
+        {"pending": PENDING, "now": timestamps.now_ms(), "limit": DELIVERY_BATCH})
+    return cur_incidents.fetchall()
+
+
+def next_retry_in(default):
+    cur_incidents.execute("SELECT min(next_attempt_ms) FROM deliveries WHERE status = ?", (PENDING,))
+    next_attempt_ms = cur_incidents.fetchone()[0]
+    if next_attempt_ms is None:
+        return default
+    return min(default, max(0, (next_attempt_ms - timestamps.now_ms()) / 1000))
+
+
+def find_reply_to(bot, chat_id, incident):
+    # Возврат в норму отвечает на сообщение о перегреве или переохлаждении, начавшемся после прошлого возврата
+    cur_incidents.execute(
+        "SELECT d.message_id FROM incidents JOIN deliveries AS d ON d.incident_id = incidents.id "
+        "WHERE incidents.tab_id = :tab_id AND incidents.sensor = :sensor AND incidents.id < :id "
+        "AND incidents.event IN ('Перегрев', 'Переохлаждение') AND incidents.id > ("
+        "SELECT COALESCE(max(id), 0) FROM incidents WHERE tab_id = :tab_id AND sensor = :sensor "
+        "AND id < :id AND event = 'Возврат в норму') "
+        "AND d.bot = :bot AND d.chat_id = :chat_id AND d.status = :sent "
+        "ORDER BY incidents.id DESC LIMIT 1",
+        {"tab_id": incident[3], "sensor": incident[4], "id": incident[0], "bot": bot_name(bot),
+         "chat_id": chat_id, "sent": SENT})
+    row = cur_incidents.fetchone()
+    return row[0] if row else None
+
+
+def mark_sent(incident_id, bot, chat_id, message_id):
+    cur_incidents.execute("UPDATE deliveries SET status = ?, attempts = attempts + 1, message_id = ? "
+                          "WHERE incident_id = ? AND bot = ? AND chat_id = ?",
+                          (SENT, message_id, incident_id, bot_name(bot), chat_id))
+    conn_incidents.commit()
+
+
+def mark_failed(incident_id, bot, chat_id, attempts):
+    if attempts >= MAX_DELIVERY_ATTEMPTS:
+        logging.error(f"Giving up on incident {incident_id} for chat_id {chat_id} using bot {bot_name(bot)} "
+                      f"after {attempts} attempts.")
+        status, next_attempt_ms = FAILED, 0
+    else:
+        status, next_attempt_ms = PENDING, timestamps.now_ms() + RETRY_DELAY_MS * 2 ** (attempts - 1)
+    cur_incidents.execute("UPDATE deliveries SET status = ?, attempts = ?, next_attempt_ms = ? "
+                          "WHERE incident_id = ? AND bot = ? AND chat_id = ?",
+                          (status, attempts, next_attempt_ms, incident_id, bot_name(bot), chat_id))
+    conn_incidents.commit()
+
+
+async def send_incident(bot, chat_id, incident, message_to_send):
+    reply_to_id = find_reply_to(bot, chat_id, incident) if incident[2] == 'Возврат в норму' else None
+
+    try:
+        sent_message = await send_limited(bot, chat_id, message_to_send, reply_to_id)
+        logging.info(
+            f"Sent '{incident[2]}' message to chat_id {chat_id} using bot {bot_name(bot)} with reply_to_id {reply_to_id}. Message: {message_to_send}")
+        logging.info(f"Message ID for '{incident[2]}': {sent_message.message_id}")
+    except Exception as e:
+        logging.error(
+            f"Error sending message to chat_id {chat_id} using bot {bot_name(bot)}: {e}")
+        if "Replied message not found" not in str(e):
+            return None
+        logging.warning(f"Retrying to send message without reply_to_message_id due to error: {e}")
+        try:
+            sent_message = await send_limited(bot, chat_id, message_to_send)
+            logging.info(
+                f"Successfully resent message to chat_id {chat_id} without reply_to_message_id.")
+            logging.info(f"Resent message ID: {sent_message.message_id}")
+        except Exception as e2:
+            logging.error(f"Failed to resend message to chat_id {chat_id}: {e2}")
+            return None
+    delivery_latencies.append(timestamps.now_ms() - timestamps.to_epoch_ms(incident[1]))
+    return sent_message
+
+
+async def send_to_chat(bot, chat_id, deliveries, messages):
+    # В одном чате сообщения идут по порядку, чтобы возврат в норму мог ответить на сообщение об инциденте
+    for incident, attempts in deliveries:
+        # Ошибка в одной доставке не должна останавливать очередь: она уходит на повтор, а потом в failed
+        try:
+            if incident[0] not in messages:
+                messages[incident[0]] = format_message(incident)
+            sent_message = await send_incident(bot, chat_id, incident, messages[incident[0]])
+        except Exception as e:
+            logging.error(f"Failed to deliver incident {incident[0]} to chat_id {chat_id} "
+                          f"using bot {bot_name(bot)}: {e}")
+            sent_message = None
+        if sent_message is None:
+            # Остальные сообщения чата подождут повтора этого
+            mark_failed(incident[0], bot, chat_id, attempts + 1)
+            return
+        mark_sent(incident[0], bot, chat_id, sent_message.message_id)
+
+
+async def deliver_pending():
+    rows = claim_deliveries()
+    bots_by_name = {bot_name(bot): bot for bot in bots}
+    chats = {}
+    for row in rows:
+        incident, bot, chat_id, attempts = row[:8], row[8], row[9], row[10]
+        chats.setdefault((bot, chat_id), []).append((incident, attempts))
+
+    # Разные чаты и боты рассылаются одновременно, частоту держат ограничители; текст каждого инцидента
+    # форматируется один раз на пачку
+    messages = {}
+    await asyncio.gather(*(send_to_chat(bots_by_name[bot], chat_id, deliveries, messages)
+                           for (bot, chat_id), deliveries in chats.items()))
+    return len(rows)
+
+
+def log_delivery_latency():
+    if not delivery_latencies:
         return
+    latencies = sorted(delivery_latencies)
 
-    message_to_send = format_message(incident)
-    key_base = (convert_tab_id(incident[3]), incident[4])
+    def percentile(fraction):
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
 
-    for bot in bots:
-        for chat_id in chat_ids:
-            key = (*key_base, chat_id[0])
-
-            try:
-                if incident[2] == 'Возврат в норму' and key in previous_messages:
-                    reply_to_id = previous_messages[key].pop()
-                    sent_message = await bot.send_message(chat_id[0], message_to_send, parse_mode='HTML',
-                                           reply_to_message_id=reply_to_id)
-                    logging.info(
-                        f"Sent 'Возврат в норму' message to chat_id {chat_id[0]} using bot {bot._token.split(':')[0]} with reply_to_id {reply_to_id}. Message: {message_to_send}")
-                    logging.info(f"Message ID for 'Возврат в норму': {sent_message.message_id}")
-                    if not previous_messages[key]:
-                        del previous_messages[key]
-                else:
-                    sent_message = await bot.send_message(chat_id[0], message_to_send, parse_mode='HTML')
-                    logging.info(
-                        f"Sent '{incident[2]}' message to chat_id {chat_id[0]} using bot {bot._token.split(':')[0]}. Message: {message_to_send}")
-                    logging.info(f"Message ID for '{incident[2]}': {sent_message.message_id}")
-                    if incident[2] in ['Перегрев', 'Переохлаждение']:
-                        if key not in previous_messages:
-                            previous_messages[key] = []
-                        previous_messages[key].append(sent_message.message_id)
-            except Exception as e:
-                logging.error(
-                    f"Error sending message to chat_id {chat_id[0]} using bot {bot._token.split(':')[0]}: {e}")
-                if "Replied message not found" in str(e):
-                    logging.warning(f"Retrying to send message without reply_to_message_id due to error: {e}")
-                    try:
-                        sent_message = await bot.send_message(chat_id[0], message_to_send, parse_mode='HTML')
-                        logging.info(
-                            f"Successfully resent message to chat_id {chat_id[0]} without reply_to_message_id.")
-                        logging.info(f"Resent message ID: {sent_message.message_id}")
-                    except Exception as e2:
-                        logging.error(f"Failed to resend message to chat_id {chat_id[0]}: {e2}")
-
-    sent_incident_ids.add(incident_id)
-
-
-cur_incidents.execute("SELECT * FROM incidents ORDER BY id DESC LIMIT 1")
-last_incident = cur_incidents.fetchone()
-
-if last_incident is not None:
-    loop.run_until_complete(send_incident(last_incident))
-    last_id = last_incident[0]
-else:
-    last_id = 0
+    logging.info(f"Delivery latency over the last {len(latencies)} messages: p50={percentile(0.5)} ms, "
+                 f"p95={percentile(0.95)} ms, p99={percentile(0.99)} ms, max={latencies[-1]} ms")
+
+
+create_outbox()
 
 try:
+    events = []
     while True:
-        cur_incidents.execute("SELECT * FROM incidents WHERE id > ?", (last_id,))
-        new_incidents = cur_incidents.fetchall()
-
-        if new_incidents:
-            logging.info(f"Found {len(new_incidents)} new incidents in the database.")
-            for incident in new_incidents:
-                loop.run_until_complete(send_incident(incident))
-                last_id = incident[0]
-        time.sleep(10)
+        enqueued = enqueue_incidents()
+        if enqueued:
+            logging.info(f"Queued {enqueued} new incidents for delivery.")
+
+        delivered = 0
+        while True:
+            claimed = loop.run_until_complete(deliver_pending())
+            if not claimed:
+                break
+            delivered += claimed
+        if delivered:
+            log_delivery_latency()
+            if events:
+                origin_ms = min(event["origin_ms"] for event in events)
+                logging.info(f"Alerts sent {timestamps.now_ms() - origin_ms} ms after the window was written, "
+                             f"{event_bus.latency_ms(events[0])} ms after the detector event")
+        events = incident_events.wait(next_retry_in(FALLBACK_POLL_INTERVAL))
 except KeyboardInterrupt:
     logging.info("KeyboardInterrupt received. Exiting...")
 finally:
+    incident_events.close()
     for bot in bots:
         loop.run_until_complete(bot.session.close())
-        logging.info(f"Closed session for bot {bot._token.split(':')[0]}.")
+        logging.info(f"Closed session for bot {bot_name(bot)}.")
 
 for bot in bots:
     loop.run_until_complete(bot.close())
-    logging.info(f"Closed bot {bot._token.split(':')[0]}.")
+    logging.info(f"Closed bot {bot_name(bot)}.")
 
 logging.info("Program finished.")
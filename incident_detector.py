@@ -1,82 +1,184 @@
+import argparse
+import logging
+import multiprocessing
+import os
 import sqlite3
-from datetime import datetime
 import signal
 import sys
 import time
-
-
-def create_incidents_db(cursor):
+import traceback
+
+import numpy as np
+
+import event_bus
+import timestamps
+from sensor_registry import SensorRegistry
+
+logging.basicConfig(filename='instance/incident_detector.log', level=logging.INFO,
+                    format='%(asctime)s [%(levelname)s] %(message)s')
+
+OVERHEAT_STATES = ("Перегрев", "Критический перегрев")
+OVERCOOL_STATES = ("Переохлаждение", "Критическое переохлаждение")
+INCIDENT_STATES = OVERHEAT_STATES + OVERCOOL_STATES
+# Коды состояний для пакетной классификации: индекс в этом кортеже
+EVENTS = ("Возврат в норму", "Перегрев", "Переохлаждение", "Критический перегрев", "Критическое переохлаждение")
+NORMAL, OVERHEAT, OVERCOOL, CRITICAL_OVERHEAT, CRITICAL_OVERCOOL = range(len(EVENTS))
+NO_STATE = -1
+# Строк temp_records за один проход классификации
+BATCH_ROWS = 100000
+# Новые строки приходят событием от data_collector; опрос temp_records — запасной путь на случай потерянного
+# события, поэтому он идёт с прежним интервалом
+FALLBACK_POLL_INTERVAL = 1
+# Раз в столько секунд в лог пишется статистика кэша настроек
+STATS_INTERVAL = 60
+
+
+def create_incidents_db(cursor, timestamp_format=timestamps.ISO):
     cursor.execute(
         "CREATE TABLE IF NOT EXISTS incidents ("
         "id INTEGER PRIMARY KEY,"
-        "datetime TEXT NOT NULL,"
+        f"datetime {timestamps.column_type(timestamp_format)} NOT NULL,"
         "event TEXT NOT NULL,"
         "tab_id INTEGER NOT NULL,"
         "sensor TEXT NOT NULL,"
         "value REAL NOT NULL,"
         "peak REAL,"
-        "duration TEXT)"
+        "duration TEXT,"
+        "sensor_id INTEGER)"
     )
-
-
-def create_states_db(cursor):
+    cursor.execute("PRAGMA table_info(incidents)")
+    if "sensor_id" not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE incidents ADD COLUMN sensor_id INTEGER")
+    # Поиск предыдущего инцидента датчика при отправке уведомлений
+    cursor.execute("CREATE INDEX IF NOT EXISTS incidents_sensor ON incidents (sensor, tab_id, id)")
+
+
+def create_states_db(cursor, timestamp_format=timestamps.ISO):
+    cursor.execute("PRAGMA table_info(states)")
+    if "sensor" in [column[1] for column in cursor.fetchall()]:
+        # Старая схема хранила состояние по имени/псевдониму датчика, переносим её на sensor_id
+        cursor.execute("ALTER TABLE states RENAME TO states_legacy")
     cursor.execute(
         "CREATE TABLE IF NOT EXISTS states ("
-        "sensor TEXT PRIMARY KEY,"
-        "state TEXT NOT NULL)"
+        "sensor_id INTEGER PRIMARY KEY,"
+        "state TEXT NOT NULL,"
+        f"since {timestamps.column_type(timestamp_format)})"
     )
+    cursor.execute("PRAGMA table_info(states)")
+    if "since" not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE states ADD COLUMN since {timestamps.column_type(timestamp_format)}")
+
 
+def migrate_legacy_sensor_keys(cursor, settings_cursor, registry):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='states_legacy'")
+    has_legacy_states = cursor.fetchone() is not None
+    cursor.execute("SELECT DISTINCT sensor FROM incidents WHERE sensor_id IS NULL")
+    legacy_sensors = [row[0] for row in cursor.fetchall()]
+    if not has_legacy_states and not legacy_sensors:
+        return
 
-def create_last_processed_timestamp_db(cursor):
+    table_by_alias = {}
+    try:
+        settings_cursor.execute("SELECT table1, table1_alias, table2, table2_alias, table3, table3_alias "
+                                "FROM tab_settings")
+        for row in settings_cursor.fetchall():
+            for table, alias in zip(row[0::2], row[1::2]):
+                if alias:
+                    table_by_alias[alias] = table
+    except sqlite3.OperationalError:
+        pass
+
+    def resolve(sensor):
+        return registry.find_by_table_name(table_by_alias.get(sensor, sensor))
+
+    for sensor in legacy_sensors:
+        sensor_id = resolve(sensor)
+        if sensor_id is not None:
+            cursor.execute("UPDATE incidents SET sensor_id = ? WHERE sensor = ? AND sensor_id IS NULL",
+                           (sensor_id, sensor))
+
+    if has_legacy_states:
+        cursor.execute("SELECT sensor, state FROM states_legacy")
+        for sensor, state in cursor.fetchall():
+            sensor_id = resolve(sensor)
+            if sensor_id is not None:
+                cursor.execute("INSERT OR REPLACE INTO states (sensor_id, state) VALUES (?, ?)", (sensor_id, state))
+        cursor.execute("DROP TABLE states_legacy")
+
+
+def create_checkpoint_db(cursor, sensors_cursor, timestamp_format=timestamps.ISO):
+    # Одна строка с id последней обработанной записи temp_records: id монотонны между секциями
     cursor.execute(
-        "CREATE TABLE IF NOT EXISTS last_processed ("
-        "id INTEGER PRIMARY KEY,"
-        "timestamp TEXT NOT NULL)"
+        "CREATE TABLE IF NOT EXISTS checkpoint ("
+        "id INTEGER PRIMARY KEY CHECK (id = 1),"
+        "last_record_id INTEGER NOT NULL)"
     )
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='last_processed'")
+    if cursor.fetchone() is None:
+        return
 
-
-def load_last_processed_timestamp(cursor):
+    # Старая таблица last_processed добавляла строку на каждом проходе; переводим её последнюю отметку в id
     cursor.execute("SELECT timestamp FROM last_processed ORDER BY id DESC LIMIT 1")
     result = cursor.fetchone()
-    return result[0] if result else None
+    if result is not None:
+        sensors_cursor.execute("SELECT max(id) FROM temp_records WHERE timestamp <= ?",
+                               (timestamps.coerce(result[0], timestamp_format),))
+        save_checkpoint(cursor, sensors_cursor.fetchone()[0] or 0)
+    cursor.execute("DROP TABLE last_processed")
 
 
-def get_peak_and_start_time(sensor, start_time, end_time, cursor):
+def load_checkpoint(cursor):
+    cursor.execute("SELECT last_record_id FROM checkpoint WHERE id = 1")
+    result = cursor.fetchone()
+    return result[0] if result else 0
+
+
+def save_checkpoint(cursor, last_record_id):
+    # Обновляется на месте в той же транзакции, что и инциденты, которые он покрывает
+    cursor.execute("INSERT INTO checkpoint (id, last_record_id) VALUES (1, ?) "
+                   "ON CONFLICT (id) DO UPDATE SET last_record_id = excluded.last_record_id", (last_record_id,))
+
+
+def get_extremes(sensor_id, start_time, end_time, cursor):
+    """Максимум и минимум огибающей датчика между start_time и end_time включительно."""
     cursor.execute(
-        "SELECT MAX(value), MIN(timestamp) FROM temp_records WHERE topic = ? AND timestamp BETWEEN ? AND ?",
-        (sensor, start_time, end_time)
+        "SELECT MAX(COALESCE(max_value, value)), MIN(COALESCE(min_value, value)) FROM temp_records "
+        "WHERE sensor_id = ? AND timestamp BETWEEN ? AND ?",
+        (sensor_id, start_time, end_time)
     )
     res = cursor.fetchone()
     return res if res else (None, None)
 
 
-def update_peak_values_for_return_to_normal(cursor, sensors_cursor):
-    # print("Starting to update peak values...")
-    cursor.execute("SELECT id, datetime, sensor FROM incidents WHERE event = 'Возврат в норму' AND peak IS NULL")
-    records_to_update = cursor.fetchall()
+def incident_peak(state, high, low):
+    # Пик перегрева — максимум, пик переохлаждения — минимум
+    return high if state in OVERHEAT_STATES else low
 
-    for record in records_to_update:
-        record_id, end_time, sensor = record
-        cursor.execute("SELECT datetime FROM incidents WHERE sensor = ? AND event IN ('Перегрев', 'Переохлаждение') "
-                       "AND datetime < ? ORDER BY datetime DESC LIMIT 1", (sensor, end_time))
-        start_time_data = cursor.fetchone()
 
-        if not start_time_data:
-            # print(f"No start time found for record {record_id}.")
-            continue
-
-        start_time = start_time_data[0]
-        sensors_cursor.execute("SELECT MAX(value) FROM temp_records WHERE topic LIKE ? AND timestamp BETWEEN ? AND ?",
-                               ('%' + sensor + '%', start_time, end_time))
-        peak_value_data = sensors_cursor.fetchone()
+def repair_peaks(cursor, sensors_cursor):
+    """Разовое восстановление пика и длительности у прошлых возвратов в норму, где их нет.
 
-        if not peak_value_data:
-            # print(f"No peak value data found for record {record_id} between {start_time} and {end_time}.")
+    В обычной работе detector пишет их сразу при возврате в норму, этот проход нужен только для
+    записей, сделанных старыми версиями.
+    """
+    cursor.execute("SELECT id, datetime, sensor_id FROM incidents WHERE event = 'Возврат в норму' "
+                   "AND (peak IS NULL OR duration IS NULL) AND sensor_id IS NOT NULL")
+    repaired = 0
+    for record_id, end_time, sensor_id in cursor.fetchall():
+        cursor.execute("SELECT event, datetime FROM incidents WHERE sensor_id = ? AND id < ? "
+                       "ORDER BY id DESC LIMIT 1", (sensor_id, record_id))
+        previous = cursor.fetchone()
+        if not previous or previous[0] not in INCIDENT_STATES:
             continue
 
-        peak_value = peak_value_data[0]
-        # print(f"Updating record {record_id} with peak value {peak_value}.")
-        cursor.execute("UPDATE incidents SET peak = ? WHERE id = ?", (peak_value, record_id))
+        event, start_time = previous
+        high, low = get_extremes(sensor_id, start_time, end_time, sensors_cursor)
+        peak_value = incident_peak(event, high, low)
+        duration = str(timestamps.to_datetime(end_time) - timestamps.to_datetime(start_time))
+        cursor.execute("UPDATE incidents SET peak = COALESCE(peak, ?), duration = COALESCE(duration, ?) "
+                       "WHERE id = ?", (peak_value, duration, record_id))
+        repaired += 1
+    return repaired
 
 
 def delete_old_incidents(cursor):
@@ -84,48 +186,363 @@ def delete_old_incidents(cursor):
     pass
 
 
-def get_tab_and_range(cursor, sensor_name):
-    # Получение tab_id, overheat, overcool, critical_overheat и critical_overcool
-    # из таблиц ranges и tab_settings
-    cursor.execute("""
-        SELECT 
-            ranges.tab_id, ranges.overheat, ranges.overcool, ranges.critical_overheat, ranges.critical_overcool, 
-            CASE 
-                WHEN tab_settings.table1 = ? THEN tab_settings.table1_alias
-                WHEN tab_settings.table2 = ? THEN tab_settings.table2_alias
-                WHEN tab_settings.table3 = ? THEN tab_settings.table3_alias
-                ELSE NULL
-            END as sensor_alias
-        FROM ranges
-        JOIN tab_settings ON ranges.tab_id = tab_settings.tab_id
-        WHERE tab_settings.table1 = ? OR tab_settings.table2 = ? OR tab_settings.table3 = ?
-        """, (sensor_name, sensor_name, sensor_name, sensor_name, sensor_name, sensor_name))
-
-    result = cursor.fetchone()
-    return result if result else (None, None, None, None, None, None)
-
-
-def get_peak_value(sensor, start_time, end_time, cursor):
-    """Функция для получения пикового значения датчика между start_time и end_time."""
-    cursor.execute(
-        "SELECT MAX(value) FROM temp_records WHERE topic = ? AND timestamp BETWEEN ? AND ?",
-        (sensor, start_time, end_time)
-    )
-    res = cursor.fetchone()
-    return res[0] if res else None
-
-
-def get_last_state(cursor, sensor):
-    cursor.execute("SELECT state FROM states WHERE sensor = ?", (sensor,))
-    result = cursor.fetchone()
+class SettingsCache:
+    """Вкладки, пороги и псевдонимы датчиков из user_settings.db, хранящиеся в памяти.
+
+    Карта датчик -> (tab_id, overheat, overcool, critical_overheat, critical_overcool, alias) строится одним
+    запросом и перестраивается, только когда меняется PRAGMA data_version (viz_app сохранил настройки) или
+    файл базы заменён. Обращения к порогам считаются: hits — ответ из готовых данных в памяти,
+    misses — обращение, которому пришлось сначала пересобрать массивы порогов.
+    """
+
+    NOT_CONFIGURED = (None, None, None, None, None, None)
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = None
+        self.file_id = None
+        self.data_version = None
+        self.settings = {}
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+        self.vectors = None
+        self.vectors_rebuild = None
+
+    def _file_id(self):
+        try:
+            stat = os.stat(self.db_path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def refresh(self):
+        file_id = self._file_id()
+        if self.conn is None or file_id is None or self.file_id is None or file_id[0] != self.file_id[0]:
+            # Файл пересоздан — старое соединение продолжало бы читать удалённую копию
+            self.close()
+            self.conn = sqlite3.connect(self.db_path)
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if file_id == self.file_id and data_version == self.data_version:
+            return
+        self.file_id = file_id
+        self.data_version = data_version
+        self.rebuild()
+
+    def rebuild(self):
+        settings = {}
+        try:
+            rows = self.conn.execute(
+                "SELECT ranges.tab_id, ranges.overheat, ranges.overcool, ranges.critical_overheat, "
+                "ranges.critical_overcool, table1, table1_alias, table2, table2_alias, table3, table3_alias "
+                "FROM ranges JOIN tab_settings ON ranges.tab_id = tab_settings.tab_id").fetchall()
+        except sqlite3.OperationalError as e:
+            logging.warning(f"Thresholds are not configured yet: {e}")
+            rows = []
+        for row in rows:
+            thresholds = row[:5]
+            for table, alias in zip(row[5::2], row[6::2]):
+                # Как и прежний запрос, берём первую вкладку, в которой встречается датчик
+                if table and table not in settings:
+                    settings[table] = thresholds + (alias,)
+        self.settings = settings
+        self.rebuilds += 1
+        logging.info(f"Loaded thresholds for {len(settings)} sensors (rebuild {self.rebuilds})")
+
+    def get(self, sensor_name):
+        self.hits += 1
+        return self.settings.get(sensor_name, self.NOT_CONFIGURED)
+
+    def log_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = f"{self.hits / lookups:.1%}" if lookups else "n/a"
+        logging.info(f"Settings cache: {lookups} lookups, hits={self.hits}, misses={self.misses} ({hit_rate}), "
+                     f"rebuilds={self.rebuilds}, sensors={len(self.settings)}")
+
+    def threshold_vectors(self, registry, max_sensor_id):
+        """Пороги в виде массивов, индексируемых sensor_id: configured, overheat, overcool,
+        critical_overheat, critical_overcool. Ненастроенный порог — NaN, сравнение с ним всегда ложно."""
+        if (self.vectors is None or self.vectors_rebuild != self.rebuilds
+                or max_sensor_id >= len(self.vectors[0])):
+            self.misses += 1
+            if registry.get_topic(max_sensor_id) is None:
+                registry.reload()
+            size = max(max_sensor_id, max(registry.topics, default=0)) + 1
+            configured = np.zeros(size, dtype=bool)
+            thresholds = np.full((4, size), np.nan)
+            for sensor_id, _ in registry.items():
+                tab_id, overheat, overcool, critical_overheat, critical_overcool, _ = self.settings.get(
+                    registry.get_table_name(sensor_id), self.NOT_CONFIGURED)
+                if tab_id is None or overheat is None or overcool is None:
+                    continue
+                configured[sensor_id] = True
+                thresholds[:, sensor_id] = [overheat, overcool,
+                                            np.nan if critical_overheat is None else critical_overheat,
+                                            np.nan if critical_overcool is None else critical_overcool]
+            self.vectors = (configured, *thresholds)
+            self.vectors_rebuild = self.rebuilds
+        else:
+            self.hits += 1
+        return self.vectors
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class SensorState:
+    """Состояние датчика в памяти: текущее событие, момент перехода в него и максимум/минимум с этого момента."""
+
+    def __init__(self, state, since=None, high=None, low=None):
+        self.state = state
+        self.since = since
+        self.high = high
+        self.low = low
+
+    def observe(self, max_value, min_value):
+        if self.high is None or max_value > self.high:
+            self.high = max_value
+        if self.low is None or min_value < self.low:
+            self.low = min_value
+
+
+def load_states(cursor, sensors_cursor, last_record_id):
+    # Состояния читаются один раз при запуске, дальше detector работает со словарём
+    cursor.execute("SELECT sensor_id, state, since FROM states")
+    states = {}
+    for sensor_id, state, since in cursor.fetchall():
+        high, low = None, None
+        if state in INCIDENT_STATES:
+            if since is None:
+                # Строки states из старой схемы не хранили начало, берём его из последнего инцидента
+                cursor.execute("SELECT datetime FROM incidents WHERE sensor_id = ? AND event = ? "
+                               "ORDER BY datetime DESC LIMIT 1", (sensor_id, state))
+                result = cursor.fetchone()
+                since = result[0] if result else None
+            if since is not None and last_record_id:
+                # Экстремумы открытого инцидента в базу не пишутся, восстанавливаем их по уже обработанным строкам
+                high, low = get_extremes(sensor_id, since, record_timestamp(sensors_cursor, last_record_id),
+                                         sensors_cursor)
+        states[sensor_id] = SensorState(state, since, high, low)
+    return states
+
+
+def record_timestamp(sensors_cursor, record_id):
+    sensors_cursor.execute("SELECT timestamp FROM temp_records WHERE id = ?", (record_id,))
+    result = sensors_cursor.fetchone()
     return result[0] if result else None
 
 
-def save_last_processed_timestamp(cursor, timestamp):
-    cursor.execute("INSERT OR REPLACE INTO last_processed (timestamp) VALUES (?)", (timestamp,))
-
-
-def main():
+def classify_batch(sensor_ids, values, max_values, min_values, vectors):
+    """Код состояния и значение для инцидента по каждой строке. Проверки идут в том же порядке, что и
+    раньше построчно: критический перегрев, критическое переохлаждение, перегрев, переохлаждение."""
+    _, overheat, overcool, critical_overheat, critical_overcool = (vector[sensor_ids] for vector in vectors)
+    conditions = [max_values > critical_overheat, min_values < critical_overcool,
+                  max_values > overheat, min_values < overcool]
+    codes = np.select(conditions, [CRITICAL_OVERHEAT, CRITICAL_OVERCOOL, OVERHEAT, OVERCOOL], default=NORMAL)
+    reported = np.select(conditions, [max_values, min_values, max_values, min_values], default=values)
+    return codes, reported
+
+
+def find_segments(sensor_ids, codes, state_codes):
+    """Разбивает строки пакета на отрезки постоянного состояния каждого датчика.
+
+    Возвращает порядок строк (по датчику, внутри — по времени), начала отрезков в этом порядке и признак
+    того, что отрезок начинается со смены состояния, а не продолжает состояние из памяти.
+    """
+    order = np.argsort(sensor_ids, kind="stable")
+    sorted_ids = sensor_ids[order]
+    sorted_codes = codes[order]
+
+    first_of_sensor = np.ones(len(order), dtype=bool)
+    first_of_sensor[1:] = sorted_ids[1:] != sorted_ids[:-1]
+    previous_codes = np.empty_like(sorted_codes)
+    previous_codes[1:] = sorted_codes[:-1]
+    previous_codes[first_of_sensor] = state_codes[sorted_ids[first_of_sensor]]
+
+    changed = sorted_codes != previous_codes
+    starts = np.flatnonzero(first_of_sensor | changed)
+    return order, starts, changed[starts]
+
+
+class ShardDetector:
+    """Состояния группы датчиков и поиск смен состояния в их строках.
+
+    В обычном режиме один экземпляр ведёт все датчики прямо в процессе detector'а, в режиме --workers
+    у каждого процесса-обработчика свой экземпляр для датчиков его шарда.
+    """
+
+    def __init__(self, states):
+        self.states = states
+        self.changed = set()
+
+    def detect(self, positions, row_timestamps, sensor_ids, values, max_values, min_values, vectors):
+        """Смены состояния в строках пакета: (позиция строки в пакете, sensor_id, событие, значение, пик,
+        длительность, время). Строки каждого датчика должны идти в порядке времени."""
+        codes, reported = classify_batch(sensor_ids, values, max_values, min_values, vectors)
+        state_codes = np.full(len(vectors[0]), NO_STATE)
+        for sensor_id, sensor_state in self.states.items():
+            if sensor_id < len(state_codes) and sensor_state.state in EVENTS:
+                state_codes[sensor_id] = EVENTS.index(sensor_state.state)
+        order, starts, transitions = find_segments(sensor_ids, codes, state_codes)
+
+        # Экстремумы каждого отрезка считаются одним проходом, в Python дальше идут только отрезки
+        highs = np.maximum.reduceat(max_values[order], starts)
+        lows = np.minimum.reduceat(min_values[order], starts)
+        changes = []
+        for start, transition, high, low in zip(order[starts].tolist(), transitions.tolist(),
+                                                highs.tolist(), lows.tolist()):
+            sensor_id = int(sensor_ids[start])
+            sensor_state = self.states.get(sensor_id)
+            if not transition:
+                sensor_state.observe(high, low)
+                continue
+
+            timestamp = row_timestamps[start]
+            new_state = EVENTS[codes[start]]
+            last_state = sensor_state.state if sensor_state else None
+            peak_value, duration = None, None
+            if new_state == EVENTS[NORMAL] and last_state in INCIDENT_STATES and sensor_state.since is not None:
+                # Строка возврата в норму тоже входит в интервал инцидента
+                sensor_state.observe(max_values[start], min_values[start])
+                peak_value = incident_peak(last_state, sensor_state.high, sensor_state.low)
+                duration = str(timestamps.to_datetime(timestamp) - timestamps.to_datetime(sensor_state.since))
+
+            changes.append((int(positions[start]), sensor_id, new_state, float(reported[start]), peak_value,
+                            duration, timestamp))
+            self.states[sensor_id] = SensorState(new_state, timestamp, high, low)
+            self.changed.add(sensor_id)
+        return changes
+
+    def take_changed(self):
+        """Датчики, сменившие состояние с прошлого вызова: (sensor_id, state, since)."""
+        changed = [(sensor_id, self.states[sensor_id].state, self.states[sensor_id].since)
+                   for sensor_id in self.changed]
+        self.changed.clear()
+        return changed
+
+    def close(self):
+        pass
+
+
+def shard_worker(conn, states):
+    # Процесс-обработчик шарда: получает строки своих датчиков и отвечает найденными сменами состояния
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    shard = ShardDetector(states)
+    while True:
+        batch = conn.recv()
+        if batch is None:
+            break
+        try:
+            conn.send((shard.detect(*batch), shard.take_changed()))
+        except Exception:
+            conn.send(traceback.format_exc())
+    conn.close()
+
+
+class ShardPool:
+    """Режим --workers: датчики распределены по процессам по sensor_id % workers.
+
+    Пакет читается из temp_records один раз здесь, строки каждого шарда уходят его процессу, а смены
+    состояния возвращаются сюда и записываются в incidents одним писателем.
+    """
+
+    def __init__(self, workers, states):
+        self.connections = []
+        self.processes = []
+        self.changed = []
+        for shard in range(workers):
+            conn, worker_conn = multiprocessing.Pipe()
+            shard_states = {sensor_id: sensor_state for sensor_id, sensor_state in states.items()
+                            if sensor_id % workers == shard}
+            process = multiprocessing.Process(target=shard_worker, args=(worker_conn, shard_states), daemon=True)
+            process.start()
+            worker_conn.close()
+            self.connections.append(conn)
+            self.processes.append(process)
+        logging.info(f"Started {workers} detector workers")
+
+    def detect(self, positions, row_timestamps, sensor_ids, values, max_values, min_values, vectors):
+        shards = sensor_ids % len(self.connections)
+        busy = []
+        for shard, conn in enumerate(self.connections):
+            selected = np.flatnonzero(shards == shard)
+            if len(selected) == 0:
+                continue
+            conn.send((positions[selected], row_timestamps[selected], sensor_ids[selected], values[selected],
+                       max_values[selected], min_values[selected], vectors))
+            busy.append(conn)
+
+        changes = []
+        for conn in busy:
+            result = conn.recv()
+            if isinstance(result, str):
+                raise RuntimeError(f"Detector worker failed:\n{result}")
+            shard_changes, shard_changed = result
+            changes.extend(shard_changes)
+            self.changed.extend(shard_changed)
+        return changes
+
+    def take_changed(self):
+        changed, self.changed = self.changed, []
+        return changed
+
+    def close(self):
+        for conn in self.connections:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+
+def process_batch(rows, detector, settings, registry, incidents_cur):
+    """Классифицирует пакет строк temp_records и записывает инциденты по сменам состояния."""
+    _, row_timestamps, sensor_ids, values, max_values, min_values = zip(*rows)
+    row_timestamps = np.array(row_timestamps, dtype=object)
+    sensor_ids = np.fromiter(sensor_ids, dtype=np.int64, count=len(rows))
+    values = np.array(values, dtype=float)
+    max_values = np.array(max_values, dtype=float)
+    min_values = np.array(min_values, dtype=float)
+    positions = np.arange(len(rows))
+
+    vectors = settings.threshold_vectors(registry, int(sensor_ids.max()))
+    configured = vectors[0][sensor_ids]
+    if not configured.all():
+        selected = np.flatnonzero(configured)
+        positions, row_timestamps, sensor_ids, values, max_values, min_values = (
+            array[selected] for array in (positions, row_timestamps, sensor_ids, values, max_values, min_values))
+    if len(sensor_ids) == 0:
+        return 0
+
+    changes = detector.detect(positions, row_timestamps, sensor_ids, values, max_values, min_values, vectors)
+
+    # Смены найдены по датчикам, а инциденты записываются в порядке строк, как их ждёт event_notification
+    changes.sort(key=lambda change: change[0])
+    incidents = []
+    for _, sensor_id, new_state, value, peak_value, duration, timestamp in changes:
+        sensor_name = registry.get_table_name(sensor_id)
+        tab_id, _, _, _, _, sensor_alias = settings.get(sensor_name)
+        sensor = sensor_alias if sensor_alias else sensor_name
+        incidents.append((timestamp, new_state, tab_id, sensor, value, peak_value, duration, sensor_id))
+    incidents_cur.executemany(
+        "INSERT INTO incidents (datetime, event, tab_id, sensor, value, peak, duration, sensor_id) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", incidents)
+    return len(incidents)
+
+
+def save_states(cursor, changed):
+    # Отложенная запись: в states попадают только датчики, сменившие состояние с прошлого коммита
+    cursor.executemany("INSERT OR REPLACE INTO states (sensor_id, state, since) VALUES (?, ?, ?)",
+                       [(sensor_id, state, since) for sensor_id, (state, since) in changed.items()])
+    changed.clear()
+
+
+def main(repair=False, workers=1):
     def signal_handler(sig, frame):
         sys.exit(0)
 
@@ -133,93 +550,97 @@ def main():
 
     incidents_conn = sqlite3.connect('instance/incidents.db')
     incidents_cur = incidents_conn.cursor()
-    settings_conn = sqlite3.connect('instance/user_settings.db')
-    settings_cur = settings_conn.cursor()
+    settings = SettingsCache('instance/user_settings.db')
+    settings.refresh()
     sensors_conn = sqlite3.connect('instance/sensors_data.db')
     sensors_cur = sensors_conn.cursor()
+    registry = SensorRegistry('instance/sensors_data.db')
+    registry.reload()
+    timestamp_format = timestamps.get_format(sensors_conn)
+    detector = None
+    records_events = None
+    incidents_events = event_bus.Publisher(event_bus.INCIDENTS)
 
     try:
-        create_incidents_db(incidents_cur)
-        create_states_db(incidents_cur)
-        create_last_processed_timestamp_db(incidents_cur)
-        last_processed_timestamp = load_last_processed_timestamp(incidents_cur)
+        create_incidents_db(incidents_cur, timestamp_format)
+        create_states_db(incidents_cur, timestamp_format)
+        migrate_legacy_sensor_keys(incidents_cur, settings.conn.cursor(), registry)
+        create_checkpoint_db(incidents_cur, sensors_cur, timestamp_format)
+        last_record_id = load_checkpoint(incidents_cur)
+        if repair:
+            repaired = repair_peaks(incidents_cur, sensors_cur)
+            incidents_conn.commit()
+            logging.info(f"Repaired peak and duration of {repaired} returns to normal")
+            return
+        states = load_states(incidents_cur, sensors_cur, last_record_id)
+        detector = ShardPool(workers, states) if workers > 1 else ShardDetector(states)
+        changed_states = {}
+        records_events = event_bus.Subscriber(event_bus.RECORDS)
+        events = []
+        next_stats = time.monotonic() + STATS_INTERVAL
 
         while True:
-            if last_processed_timestamp is None:
-                sensors_cur.execute("SELECT timestamp, topic, value FROM temp_records ORDER BY timestamp")
-            else:
-                sensors_cur.execute("SELECT timestamp, topic, value FROM temp_records "
-                                    "WHERE timestamp > ? ORDER BY timestamp", (last_processed_timestamp,))
+            # Классификация по огибающей окна (min/max), чтобы кратковременные выбросы не терялись в среднем
+            sensors_cur.execute("SELECT id, timestamp, sensor_id, value, COALESCE(max_value, value), "
+                                "COALESCE(min_value, value) FROM temp_records "
+                                "WHERE id > ? ORDER BY id", (last_record_id,))
 
             delete_old_incidents(incidents_cur)
+            settings.refresh()
+            new_incidents = 0
+
+            # Строки классифицируются пакетами массивов NumPy, построчно в Python обрабатываются только смены состояний
+            while True:
+                rows = sensors_cur.fetchmany(BATCH_ROWS)
+                if not rows:
+                    break
+                last_record_id = rows[-1][0]
+                new_incidents += process_batch(rows, detector, settings, registry, incidents_cur)
+                changed_states.update((sensor_id, (state, since))
+                                      for sensor_id, state, since in detector.take_changed())
+
+            save_states(incidents_cur, changed_states)
+            save_checkpoint(incidents_cur, last_record_id)
+            incidents_conn.commit()
 
-            for row in sensors_cur:
-                timestamp, sensor, value = row
-                last_processed_timestamp = timestamp
-                peak_value = None  # Инициализация перед использованием
-                duration = None  # Инициализация перед использованием
-                sensor_name = sensor.replace('/', '_')
-                tab_id, overheat, overcool, critical_overheat, critical_overcool, sensor_alias = get_tab_and_range(
-                    settings_cur, sensor_name)
-
-                if tab_id is None or overheat is None or overcool is None:
-                    continue
+            if new_incidents:
+                # Задержка считается от записи окна сборщиком, если проход был разбужен его событием
+                origin_ms = min((event["origin_ms"] for event in events), default=None)
+                incidents_events.publish(origin_ms, incidents=new_incidents)
+                if origin_ms is not None:
+                    logging.info(f"{new_incidents} new incidents {timestamps.now_ms() - origin_ms} ms "
+                                 f"after the window was written")
 
-                sensor = sensor_alias if sensor_alias else sensor_name
-                last_state = get_last_state(incidents_cur, sensor)
-
-                if value > critical_overheat:
-                    new_state = "Критический перегрев"
-                elif value < critical_overcool:
-                    new_state = "Критическое переохлаждение"
-                elif value > overheat:
-                    new_state = "Перегрев"
-                elif value < overcool:
-                    new_state = "Переохлаждение"
-                else:
-                    if last_state in ["Перегрев", "Переохлаждение", "Критический перегрев", "Критическое переохлаждение"]:
-                        # Получение timestamp начала инцидента
-                        incidents_cur.execute("SELECT datetime FROM incidents WHERE sensor = ? AND event = ? "
-                                              "ORDER BY datetime DESC LIMIT 1", (sensor, last_state))
-                        incident_start_timestamp = incidents_cur.fetchone()
-                        if incident_start_timestamp:
-                            incident_start_timestamp = incident_start_timestamp[0]
-                            peak_value = get_peak_value(sensor_name, incident_start_timestamp, timestamp, sensors_cur)
-                            duration = (
-                                    datetime.fromisoformat(timestamp) -
-                                    datetime.fromisoformat(incident_start_timestamp)
-                            )
-                            duration = str(duration)
-                        else:
-                            peak_value, duration = None, None
-                    else:
-                        peak_value, duration = None, None
-                    new_state = "Возврат в норму"
-
-                incidents_cur.execute("INSERT OR REPLACE INTO states (sensor, state) "
-                                      "VALUES (?, ?)", (sensor, new_state))
-
-                if new_state != last_state:
-                    incidents_cur.execute(
-                        "INSERT INTO incidents (datetime, event, tab_id, sensor, value, peak, duration) "
-                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
-                        (timestamp, new_state, tab_id, sensor, value, peak_value, duration))
-
-            save_last_processed_timestamp(incidents_cur, last_processed_timestamp)
-            update_peak_values_for_return_to_normal(incidents_cur, sensors_cur)
-            incidents_conn.commit()
+            if time.monotonic() >= next_stats:
+                settings.log_stats()
+                next_stats = time.monotonic() + STATS_INTERVAL
 
-            time.sleep(1)  # задержка в 1 секунду
+            # Ждём события о новых строках; по таймауту проходим по temp_records как раньше
+            events = records_events.wait(FALLBACK_POLL_INTERVAL)
+            if events:
+                logging.debug(f"Woken by {len(events)} events, {event_bus.latency_ms(events[0])} ms after publish")
 
     except Exception as e:
-        print(f"An error occurred: {e}")
+        logging.exception(f"An error occurred: {e}")
         incidents_conn.rollback()
 
     finally:
         incidents_conn.close()
         sensors_conn.close()
-        settings_conn.close()
+        settings.close()
+        registry.close()
+        incidents_events.close()
+        if records_events is not None:
+            records_events.close()
+        if detector is not None:
+            detector.close()
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Turns sensor readings into incidents in incidents.db")
+    parser.add_argument("--repair-peaks", action="store_true",
+                        help="fill in missing peak and duration of past returns to normal and exit")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="classify in this many processes, sharding sensors by id (default: 1, no sharding)")
+    args = parser.parse_args()
+    main(args.repair_peaks, max(args.workers, 1))
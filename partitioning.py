@@ -0,0 +1,221 @@
+import logging
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+import timestamps
+
+MONTHLY = "monthly"
+WEEKLY = "weekly"
+DAILY = "daily"
+PERIODS = (MONTHLY, WEEKLY, DAILY)
+
+LEGACY_PARTITION = "temp_records_legacy"
+# meta key holding the largest id retention has deleted, so ids never restart below it
+ID_HIGH_WATER_KEY = "id_high_water"
+
+TEMP_RECORDS_COLUMNS = ("id, timestamp, sensor_id, value, sample_count, min_value, max_value, sum_value, "
+                        "first_value, last_value")
+
+
+def create_partitions_table(conn):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS partitions ("
+        "name TEXT PRIMARY KEY,"
+        "start_time NOT NULL,"
+        "end_time NOT NULL)"
+    )
+
+
+def create_partition_table(conn, table_name, timestamp_type="TEXT"):
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {table_name} ("
+        "id INTEGER PRIMARY KEY,"
+        f"timestamp {timestamp_type} NOT NULL,"
+        "sensor_id INTEGER NOT NULL,"
+        "value REAL NOT NULL,"
+        "sample_count INTEGER NOT NULL DEFAULT 1,"
+        "min_value REAL,"
+        "max_value REAL,"
+        "sum_value REAL,"
+        "first_value REAL,"
+        "last_value REAL)"
+    )
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_sensor_timestamp "
+                 f"ON {table_name} (sensor_id, timestamp, value)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_timestamp ON {table_name} (timestamp)")
+
+
+def period_bounds(moment, period):
+    """Start and end (exclusive) of the partition period containing ``moment``, plus its table name."""
+    moment = moment.astimezone(timezone.utc)
+    if period == DAILY:
+        start = datetime(moment.year, moment.month, moment.day, tzinfo=timezone.utc)
+        return start, start + timedelta(days=1), f"temp_records_{start:%Y_%m_%d}"
+    if period == WEEKLY:
+        start = datetime(moment.year, moment.month, moment.day, tzinfo=timezone.utc)
+        start -= timedelta(days=moment.weekday())
+        iso_year, iso_week, _ = start.isocalendar()
+        return start, start + timedelta(days=7), f"temp_records_{iso_year}_w{iso_week:02d}"
+    if period == MONTHLY:
+        start = datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+        end = datetime(moment.year + moment.month // 12, moment.month % 12 + 1, 1, tzinfo=timezone.utc)
+        return start, end, f"temp_records_{start:%Y_%m}"
+    raise ValueError(f"Unknown partition period: {period}")
+
+
+def list_partitions(conn):
+    """Partitions as (name, start, end) with bounds parsed to datetimes, oldest first."""
+    rows = conn.execute("SELECT name, start_time, end_time FROM partitions").fetchall()
+    partitions = [(name, timestamps.to_datetime(start), timestamps.to_datetime(end)) for name, start, end in rows]
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def get_id_high_water(conn):
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (ID_HIGH_WATER_KEY,)).fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return int(row[0]) if row else 0
+
+
+def rebuild_view(conn):
+    names = [name for name, _, _ in list_partitions(conn)]
+    conn.execute("DROP VIEW IF EXISTS temp_records")
+    if not names:
+        return
+    union = " UNION ALL ".join(f"SELECT {TEMP_RECORDS_COLUMNS} FROM {name}" for name in names)
+    conn.execute(f"CREATE VIEW temp_records AS {union}")
+
+
+class PartitionRouter:
+    """Routes temp_records rows to per-period tables behind the ``temp_records`` UNION ALL view.
+
+    Retention drops whole partitions instead of deleting rows. Callers run ``partition_for`` outside
+    of their write transaction, because creating a partition commits its own DDL.
+    """
+
+    def __init__(self, conn, period=MONTHLY, timestamp_format=timestamps.ISO):
+        if period not in PERIODS:
+            raise ValueError(f"Unknown partition period: {period}")
+        self.conn = conn
+        self.period = period
+        self.timestamp_format = timestamp_format
+        self.partitions = list_partitions(conn)
+        self.last_partition = None
+
+    def partition_for(self, timestamp):
+        moment = timestamps.to_datetime(timestamp)
+        last = self.last_partition
+        if last is not None and last[1] <= moment < last[2]:
+            return last[0]
+
+        for partition in reversed(self.partitions):
+            if partition[1] <= moment < partition[2]:
+                self.last_partition = partition
+                return partition[0]
+
+        return self.create_partition(moment)
+
+    def create_partition(self, moment):
+        start, end, name = period_bounds(moment, self.period)
+        # Fill only the gap around ``moment`` so we never overlap the legacy partition or partitions
+        # left over from a different period setting
+        for _, existing_start, existing_end in self.partitions:
+            if start < existing_end <= moment:
+                start = existing_end
+            if moment < existing_start < end:
+                end = existing_start
+        existing_names = {partition[0] for partition in self.partitions}
+        suffix = 1
+        base_name = name
+        while name in existing_names:
+            suffix += 1
+            name = f"{base_name}_{suffix}"
+
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            create_partition_table(self.conn, name, timestamps.column_type(self.timestamp_format))
+            self.conn.execute("INSERT INTO partitions (name, start_time, end_time) VALUES (?, ?, ?)",
+                              (name, timestamps.from_datetime(start, self.timestamp_format),
+                               timestamps.from_datetime(end, self.timestamp_format)))
+            self.partitions = list_partitions(self.conn)
+            rebuild_view(self.conn)
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            self.partitions = list_partitions(self.conn)
+            raise
+
+        logging.info(f"Created partition {name} for {start.isoformat()} .. {end.isoformat()}")
+        partition = (name, start, end)
+        self.last_partition = partition
+        return name
+
+    def max_id(self):
+        """Largest id ever written, including rows retention has already deleted."""
+        max_id = get_id_high_water(self.conn)
+        for name, _, _ in self.partitions:
+            partition_max = self.conn.execute(f"SELECT max(id) FROM {name}").fetchone()[0]
+            if partition_max is not None and partition_max > max_id:
+                max_id = partition_max
+        return max_id
+
+    def drop_older_than(self, cutoff):
+        """Drop every partition that ends at or before ``cutoff``; returns the dropped names."""
+        self.trim_legacy(cutoff)
+        expired = [name for name, _, end in self.partitions if end <= cutoff]
+        if not expired:
+            return []
+
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.save_id_high_water(expired)
+            for name in expired:
+                self.conn.execute("DELETE FROM partitions WHERE name = ?", (name,))
+            rebuild_view(self.conn)
+            for name in expired:
+                self.conn.execute(f"DROP TABLE IF EXISTS {name}")
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        finally:
+            self.partitions = list_partitions(self.conn)
+            self.last_partition = None
+        return expired
+
+    def trim_legacy(self, cutoff):
+        """Delete the expired rows of the legacy partition while it still straddles ``cutoff``.
+
+        It holds all history from before partitioning, so dropping it only as a whole would keep its oldest
+        rows for up to its whole span past retention.
+        """
+        for name, start, end in self.partitions:
+            if name != LEGACY_PARTITION or not start < cutoff < end:
+                continue
+            bound = timestamps.from_datetime(cutoff, self.timestamp_format)
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.save_id_high_water([name])
+                deleted = self.conn.execute(f"DELETE FROM {name} WHERE timestamp < ?", (bound,)).rowcount
+                self.conn.execute("UPDATE partitions SET start_time = ? WHERE name = ?", (bound, name))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            finally:
+                self.partitions = list_partitions(self.conn)
+                self.last_partition = None
+            logging.info(f"Deleted {deleted} expired rows from {name}")
+
+    def save_id_high_water(self, names):
+        """Keep the largest id of the ``names`` tables in meta before their rows are deleted.
+
+        Readers use ids as a watermark; without it, dropping every partition would restart ids from 1.
+        """
+        high_water = max((self.conn.execute(f"SELECT max(id) FROM {name}").fetchone()[0] or 0 for name in names),
+                         default=0)
+        if high_water > get_id_high_water(self.conn):
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                              (ID_HIGH_WATER_KEY, high_water))
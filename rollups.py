@@ -0,0 +1,74 @@
+import timestamps
+
+# (name, bucket length in seconds), finest first
+RESOLUTIONS = (("1m", 60), ("1h", 60 * 60), ("1d", 24 * 60 * 60))
+# Minute buckets expire together with the raw rows; hour and day buckets are kept for long-term trends
+EXPIRING_RESOLUTIONS = ("1m",)
+
+TABLE_PREFIX = "rollup_"
+PROGRESS_TABLE = "rollup_progress"
+
+
+def table_name(resolution):
+    return f"{TABLE_PREFIX}{resolution}"
+
+
+def create_tables_sql():
+    statements = [
+        f"CREATE TABLE IF NOT EXISTS {table_name(resolution)} ("
+        "sensor_id INTEGER NOT NULL,"
+        "bucket INTEGER NOT NULL,"
+        "min_value REAL NOT NULL,"
+        "max_value REAL NOT NULL,"
+        "sum_value REAL NOT NULL,"
+        "count INTEGER NOT NULL,"
+        "PRIMARY KEY (sensor_id, bucket)) WITHOUT ROWID"
+        for resolution, _ in RESOLUTIONS
+    ]
+    # Last row of each sensor already counted in the rollups: by id for per-topic tables, by timestamp for
+    # the narrow readings table
+    statements.append(f"CREATE TABLE IF NOT EXISTS {PROGRESS_TABLE} "
+                      "(sensor_id INTEGER PRIMARY KEY, last_id INTEGER, last_timestamp)")
+    return statements
+
+
+def epoch_seconds_sql(column, timestamp_format):
+    if timestamp_format == timestamps.EPOCH_MS:
+        return f"({column} / 1000)"
+    return f"CAST(strftime('%s', {column}) AS INTEGER)"
+
+
+def upsert_sql(resolution, source_table, condition, timestamp_format):
+    """Fold the rows of ``source_table`` matching ``condition`` into the ``:sensor_id`` buckets of ``resolution``.
+
+    min/max come from the windows' own min_value/max_value, so spikes inside a window survive; rows copied before
+    those columns existed only have their average.
+    """
+    seconds = dict(RESOLUTIONS)[resolution]
+    bucket = f"{epoch_seconds_sql('timestamp', timestamp_format)} / {seconds} * {seconds}"
+    return (
+        f"INSERT INTO {table_name(resolution)} (sensor_id, bucket, min_value, max_value, sum_value, count) "
+        f"SELECT :sensor_id, {bucket}, min(COALESCE(min_value, value)), max(COALESCE(max_value, value)), "
+        f"sum(value), count(*) FROM {source_table} "
+        f"WHERE {condition} AND value IS NOT NULL AND timestamp IS NOT NULL GROUP BY 2 "
+        f"ON CONFLICT (sensor_id, bucket) DO UPDATE SET "
+        f"min_value = min(min_value, excluded.min_value), "
+        f"max_value = max(max_value, excluded.max_value), "
+        f"sum_value = sum_value + excluded.sum_value, "
+        f"count = count + excluded.count"
+    )
+
+
+def select_series_sql(resolution):
+    return (f"SELECT bucket, min_value, max_value, sum_value / count, count FROM {table_name(resolution)} "
+            f"WHERE sensor_id = :sensor_id AND bucket >= :start AND bucket <= :end ORDER BY bucket")
+
+
+def choose_resolution(start, end, points):
+    """Coarsest resolution that still yields at least ``points`` buckets between two datetimes,
+    or None when only the raw rows are fine enough."""
+    span = (end - start).total_seconds()
+    for resolution, seconds in reversed(RESOLUTIONS):
+        if span / seconds >= points:
+            return resolution
+    return None
@@ -0,0 +1,86 @@
+import sqlite3
+import threading
+
+
+def create_sensors_table(conn):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS sensors ("
+        "id INTEGER PRIMARY KEY,"
+        "topic TEXT NOT NULL UNIQUE)"
+    )
+
+
+def topic_to_table_name(topic):
+    return topic.replace('/', '_')
+
+
+class SensorRegistry:
+    """Dictionary of MQTT topics interned to integer sensor ids.
+
+    The ``sensors`` table in sensors_data.db is the source of truth; every process keeps an in-memory copy
+    and only goes back to the database for topics or ids it has not seen yet.
+    """
+
+    def __init__(self, database_name):
+        self.db_name = database_name
+        self.conn = None
+        self.lock = threading.Lock()
+        self.ids = {}
+        self.topics = {}
+
+    def _connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_name, isolation_level=None, check_same_thread=False)
+            create_sensors_table(self.conn)
+        return self.conn
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def reload(self):
+        with self.lock:
+            for sensor_id, topic in self._connect().execute("SELECT id, topic FROM sensors"):
+                self.ids[topic] = sensor_id
+                self.topics[sensor_id] = topic
+
+    def lookup(self, topic):
+        """Return the id of ``topic`` if it is already known to this process, without touching the database."""
+        return self.ids.get(topic)
+
+    def get_id(self, topic):
+        """Return the id of ``topic``, registering it on first sighting."""
+        sensor_id = self.ids.get(topic)
+        if sensor_id is not None:
+            return sensor_id
+
+        with self.lock:
+            conn = self._connect()
+            conn.execute("INSERT OR IGNORE INTO sensors (topic) VALUES (?)", (topic,))
+            sensor_id = conn.execute("SELECT id FROM sensors WHERE topic = ?", (topic,)).fetchone()[0]
+            self.ids[topic] = sensor_id
+            self.topics[sensor_id] = topic
+        return sensor_id
+
+    def get_topic(self, sensor_id):
+        topic = self.topics.get(sensor_id)
+        if topic is None:
+            # Registered by another process after our last reload
+            self.reload()
+            topic = self.topics.get(sensor_id)
+        return topic
+
+    def get_table_name(self, sensor_id):
+        topic = self.get_topic(sensor_id)
+        return topic_to_table_name(topic) if topic is not None else None
+
+    def find_by_table_name(self, table_name):
+        for sensor_id, topic in self.topics.items():
+            if topic_to_table_name(topic) == table_name:
+                return sensor_id
+        return None
+
+    def items(self):
+        return sorted(self.topics.items())
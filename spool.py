@@ -0,0 +1,115 @@
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+MAGIC = b"ATSPOOL1"
+# magic, record size, capacity, flushed sequence number; padded to one record
+HEADER = struct.Struct("<8sIIQ")
+# sequence number, timestamp (epoch ms), sensor id, value, crc32 of the preceding fields
+RECORD = struct.Struct("<QqidI")
+RECORD_BODY = struct.Struct("<Qqid")
+RECORD_SIZE = RECORD.size
+
+
+class Spool:
+    """Memory-mapped circular log of samples that have been accepted but not yet written to the database.
+
+    Every accepted sample is copied into a fixed-size slot of the mapping, so appending is a plain memory
+    write with no system call; the page cache keeps it if the process dies. After a successful database flush
+    the consumer commits the sequence number it has stored, which logically truncates the spool. Records
+    newer than that watermark are replayed at startup.
+
+    ``append`` is called from the producer thread only and ``commit`` from the consumer thread only.
+    """
+
+    def __init__(self, path, capacity=100000):
+        self.path = path
+        self.capacity = capacity
+        self.pending = []
+        self.flushed_seq = 0
+        self.overruns = 0
+
+        if os.path.exists(path):
+            self.flushed_seq, self.pending = self._read(path)
+        self.next_seq = max([self.flushed_seq] + [record[0] for record in self.pending]) + 1
+        self.base_seq = self.next_seq
+
+        # Start from a fresh file holding only the unflushed records, so stale slots never come back
+        self._rewrite()
+        self.file = open(path, "r+b")
+        self.mm = mmap.mmap(self.file.fileno(), self._file_size())
+
+    def _file_size(self, capacity=None):
+        return RECORD_SIZE * ((capacity or self.capacity) + 1)
+
+    @staticmethod
+    def _read(path):
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) < RECORD_SIZE:
+            return 0, []
+        magic, record_size, capacity, flushed_seq = HEADER.unpack_from(data)
+        if magic != MAGIC or record_size != RECORD_SIZE:
+            logging.warning(f"Ignoring spool file {path} with an unknown format")
+            return 0, []
+
+        records = {}
+        body_size = RECORD_BODY.size
+        for slot in range(1, min(capacity + 1, len(data) // RECORD_SIZE)):
+            offset = slot * RECORD_SIZE
+            seq, msg_timestamp, sensor_id, value, crc = RECORD.unpack_from(data, offset)
+            # Slots that were never written or were torn by a crash fail the checksum
+            if seq > flushed_seq and crc == zlib.crc32(data[offset:offset + body_size]):
+                records[seq] = (seq, msg_timestamp, sensor_id, value)
+        return flushed_seq, [records[seq] for seq in sorted(records)]
+
+    def _rewrite(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w+b") as f:
+            f.truncate(self._file_size())
+            with mmap.mmap(f.fileno(), self._file_size()) as mm:
+                HEADER.pack_into(mm, 0, MAGIC, RECORD_SIZE, self.capacity, self.flushed_seq)
+                for seq, msg_timestamp, sensor_id, value in self.pending[-self.capacity:]:
+                    self._write_record(mm, seq, msg_timestamp, sensor_id, value)
+                mm.flush()
+        os.replace(temp_path, self.path)
+
+    def _write_record(self, mm, seq, msg_timestamp, sensor_id, value):
+        crc = zlib.crc32(RECORD_BODY.pack(seq, msg_timestamp, sensor_id, value))
+        RECORD.pack_into(mm, (seq % self.capacity + 1) * RECORD_SIZE, seq, msg_timestamp, sensor_id, value, crc)
+
+    def append(self, sample):
+        seq = self.next_seq
+        if seq - self.flushed_seq > self.capacity:
+            # The consumer is too far behind; the oldest unflushed record is overwritten
+            self.overruns += 1
+        msg_timestamp, sensor_id, value = sample
+        self._write_record(self.mm, seq, msg_timestamp, sensor_id, value)
+        self.next_seq = seq + 1
+        return seq
+
+    def replay(self):
+        """Samples left unflushed by the previous run, oldest first, and the last sequence number among them."""
+        samples = [(msg_timestamp, sensor_id, value) for _, msg_timestamp, sensor_id, value in self.pending]
+        last_seq = self.pending[-1][0] if self.pending else self.flushed_seq
+        return samples, last_seq
+
+    def commit(self, seq):
+        """Everything up to and including ``seq`` is in the database."""
+        if seq <= self.flushed_seq:
+            return
+        self.flushed_seq = seq
+        self.pending = []
+        HEADER.pack_into(self.mm, 0, MAGIC, RECORD_SIZE, self.capacity, seq)
+        self.mm.flush()
+
+    @property
+    def depth(self):
+        return self.next_seq - 1 - self.flushed_seq
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        self.file.close()
@@ -0,0 +1,89 @@
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+ISO = "iso"
+EPOCH_MS = "epoch_ms"
+FORMATS = (ISO, EPOCH_MS)
+
+
+def now_ms():
+    return time.time_ns() // 1_000_000
+
+
+def now(fmt=ISO):
+    if fmt == EPOCH_MS:
+        return now_ms()
+    return datetime.now(timezone.utc).isoformat()
+
+
+def to_datetime(value):
+    """Parse a stored timestamp (epoch milliseconds or ISO-8601 text) into an aware UTC datetime."""
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, str) and value.isdigit():
+        value = int(value)
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value / 1000, timezone.utc)
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def to_epoch_ms(value):
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return int(round(to_datetime(value).timestamp() * 1000))
+
+
+def from_datetime(dt, fmt=ISO):
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    if fmt == EPOCH_MS:
+        return int(round(dt.timestamp() * 1000))
+    return dt.astimezone(timezone.utc).isoformat()
+
+
+def coerce(value, fmt=ISO):
+    """Convert a timestamp in any supported representation into ``fmt``."""
+    if value is None:
+        return None
+    if fmt == EPOCH_MS:
+        return to_epoch_ms(value)
+    return from_datetime(to_datetime(value), ISO)
+
+
+def column_type(fmt=ISO):
+    return "INTEGER" if fmt == EPOCH_MS else "TEXT"
+
+
+def epoch_ms_sql(column, fmt=ISO):
+    """SQL expression turning a stored timestamp column into integer epoch milliseconds."""
+    if fmt == EPOCH_MS:
+        return column
+    return f"CAST(round((julianday({column}) - 2440587.5) * 86400000) AS INTEGER)"
+
+
+def get_format(conn):
+    """Timestamp format recorded in the ``meta`` table of sensors_data.db, ISO-8601 by default."""
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'timestamp_format'").fetchone()
+    except sqlite3.OperationalError:
+        return ISO
+    return row[0] if row else ISO
+
+
+def set_format(conn, fmt):
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown timestamp format: {fmt}")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('timestamp_format', ?)", (fmt,))
+
+
+def read_format(database_name):
+    conn = sqlite3.connect(database_name)
+    try:
+        return get_format(conn)
+    finally:
+        conn.close()
@@ -1,22 +1,41 @@
+import configparser
 import os
 import sqlite3
 
 import pytz
-from flask import Flask, g, render_template, send_from_directory, request, redirect, flash, url_for
+from flask import Flask, g, render_template, send_from_directory, request, redirect, flash, url_for, jsonify
 from flask_bootstrap import Bootstrap
-from dateutil.parser import parse
 import pandas as pd
 import json
 import plotly.graph_objs as go
 import plotly
 from datetime import datetime, time, timedelta
 
+import compression
+import rollups
+import timestamps
+from sensor_registry import SensorRegistry, topic_to_table_name
+
 app = Flask(__name__)
 bootstrap = Bootstrap(app)
 app.secret_key = os.urandom(24)
 
 DATABASE1 = os.path.join(os.path.dirname(__file__), 'instance', 'sorted_data.db')
 DATABASE2 = os.path.join(os.path.dirname(__file__), 'instance', 'user_settings.db')
+DATABASE3 = os.path.join(os.path.dirname(__file__), 'instance', 'sensors_data.db')
+COLLECTOR_CONFIG = os.path.join(os.path.dirname(__file__), 'instance', 'data-collector.conf')
+
+sensor_registry = SensorRegistry(DATABASE3)
+
+# Настройки сжатия коллектора: при сжатии стабильный датчик пишет строку лишь раз в max_interval
+collector_config = configparser.ConfigParser()
+collector_config.read(COLLECTOR_CONFIG)
+
+# Через сколько секунд без новых данных датчик без сжатия считается отключённым
+STATUS_TIMEOUT = 120
+
+# Сколько точек как минимум должно попасть на график; по нему выбирается разрешение агрегатов
+DEFAULT_POINTS = 500
 
 
 # Вспомогательные функции
@@ -49,11 +68,60 @@ def execute_with_retry(cursor, query, params=()):
                 raise  # Raise the exception if it's not a 'database is locked' error
 
 
-def check_status(time):
+def get_timestamp_format():
+    # Формат хранения читается один раз за запрос
+    timestamp_format = getattr(g, '_timestamp_format', None)
+    if timestamp_format is None:
+        timestamp_format = g._timestamp_format = timestamps.read_format(DATABASE3)
+    return timestamp_format
+
+
+def to_datetime_series(values, timestamp_format):
+    # Метки времени хранятся либо как ISO-8601, либо как миллисекунды эпохи
+    if timestamp_format == timestamps.EPOCH_MS:
+        return pd.to_datetime(values, unit='ms', utc=True)
+    return pd.to_datetime(values, format='ISO8601')
+
+
+def load_series(cursor, table, start_time, end_time, points, timestamp_format):
+    """Строки (id, timestamp, avg, min, max, count) датчика за период и выбранное разрешение.
+
+    Берётся самый грубый агрегат из rollup-таблиц, который даёт не меньше ``points`` точек;
+    если период слишком короткий, читаются исходные строки.
+    """
+    resolution = rollups.choose_resolution(timestamps.to_datetime(start_time), timestamps.to_datetime(end_time),
+                                           points)
+    sensor_id = sensor_registry.find_by_table_name(table)
+    if resolution is not None and sensor_id is not None:
+        cursor.execute(rollups.select_series_sql(resolution),
+                       {"sensor_id": sensor_id,
+                        "start": int(timestamps.to_datetime(start_time).timestamp()),
+                        "end": int(timestamps.to_datetime(end_time).timestamp())})
+        # id нужен только для сортировки таблицы на странице, начало интервала подходит
+        rows = [(bucket, timestamps.from_datetime(datetime.fromtimestamp(bucket, pytz.UTC), timestamp_format),
+                 avg_value, min_value, max_value, count)
+                for bucket, min_value, max_value, avg_value, count in cursor.fetchall()]
+        return rows, resolution
+
+    cursor.execute(f"SELECT id, timestamp, value, COALESCE(min_value, value), COALESCE(max_value, value) "
+                   f"FROM {table} WHERE timestamp BETWEEN ? AND ? ORDER BY timestamp", (start_time, end_time))
+    return [(row_id, timestamp, value, min_value, max_value, 1)
+            for row_id, timestamp, value, min_value, max_value in cursor.fetchall()], None
+
+
+def status_timeout(topic):
+    # Со сжатием стабильный датчик молчит до max_interval, это не отключение
+    if topic is None:
+        return STATUS_TIMEOUT
+    silence = compression.max_silence(compression.options_for(collector_config, topic))
+    return STATUS_TIMEOUT if silence is None else STATUS_TIMEOUT + silence
+
+
+def check_status(time, timeout=STATUS_TIMEOUT):
     current_time = datetime.now(pytz.UTC)
     # print(f"Time type: {type(time)}, Time value: {time}")
-    time_difference = current_time - datetime.strptime(time, '%Y-%m-%dT%H:%M:%S.%f%z')
-    return "Online" if time_difference.total_seconds() < 120 else "Offline"
+    time_difference = current_time - timestamps.to_datetime(time)
+    return "Online" if time_difference.total_seconds() < timeout else "Offline"
 
 
 def get_users():
@@ -65,49 +133,51 @@ def get_users():
 
 
 def get_table_names():
+    # Таблицы датчиков берутся из справочника sensors, служебные таблицы sorted_data.db в список не попадают.
+    # В узком режиме хранения у датчиков вместо таблиц представления над readings
+    sensor_registry.reload()
     cur = get_db(DATABASE1).cursor()
-    cur.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = cur.fetchall()
+    cur.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view');")
+    existing_tables = {table[0] for table in cur.fetchall()}
 
     table_names = []
-    for table in tables:
-        if table[0] == 'last_update':
-            continue
-        table_names.append(table[0])
+    for sensor_id, topic in sensor_registry.items():
+        table_name = topic_to_table_name(topic)
+        if table_name in existing_tables:
+            table_names.append(table_name)
     return table_names
 
 
 def get_table_data():
     cur = get_db(DATABASE1).cursor()
-    cur.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = cur.fetchall()
 
-    table_data = []
-    user_cur = get_user_db().cursor()
-    for table in tables:
-        if table[0] == 'last_update':
-            continue
-        cur.execute(f"SELECT * FROM {table[0]} ORDER BY timestamp DESC LIMIT 1;")
-        row = cur.fetchone()
-        _, time, value = row  # здесь происходит изменение
+    # Последние показания всех датчиков и вкладки, к которым они привязаны, читаются двумя запросами
+    try:
+        cur.execute("SELECT sensor_id, timestamp, value FROM latest_readings")
+        latest = {sensor_registry.get_table_name(sensor_id): (sensor_id, time, value)
+                  for sensor_id, time, value in cur.fetchall()}
+    except sqlite3.OperationalError:
+        latest = {}
 
-        try:
-            user_cur.execute("SELECT tab_name, table1, table1_alias, table2, table2_alias, table3, table3_alias "
-                             "FROM tab_settings JOIN tabs ON tab_settings.tab_id = tabs.id "
-                             "WHERE table1 = ? OR table2 = ? OR table3 = ?", (table[0], table[0], table[0]))
-            tab_info = user_cur.fetchone()
-        except sqlite3.OperationalError:
-            tab_info = None
-
-        if tab_info:
-            tab_name, table1, table1_alias, table2, table2_alias, table3, table3_alias = tab_info
-            aliases = {table1: table1_alias, table2: table2_alias, table3: table3_alias}
-            alias = aliases.get(table[0], 'Unknown')
-        else:
-            tab_name = 'Unknown'
-            alias = 'Unknown'
+    tab_info = {}
+    user_cur = get_user_db().cursor()
+    try:
+        user_cur.execute("SELECT tab_name, table1, table1_alias, table2, table2_alias, table3, table3_alias "
+                         "FROM tab_settings JOIN tabs ON tab_settings.tab_id = tabs.id")
+        for tab_name, table1, table1_alias, table2, table2_alias, table3, table3_alias in user_cur.fetchall():
+            for table, alias in ((table1, table1_alias), (table2, table2_alias), (table3, table3_alias)):
+                tab_info.setdefault(table, (tab_name, alias))
+    except sqlite3.OperationalError:
+        pass
 
-        table_data.append((table[0], alias, tab_name, time, check_status(time), value))
+    table_data = []
+    for table_name in get_table_names():
+        if table_name not in latest:
+            continue
+        sensor_id, time, value = latest[table_name]
+        tab_name, alias = tab_info.get(table_name, ('Unknown', 'Unknown'))
+        status = check_status(time, status_timeout(sensor_registry.get_topic(sensor_id)))
+        table_data.append((table_name, alias, tab_name, time, status, value))
     return table_data
 
 
@@ -146,6 +216,9 @@ def get_incidents(tab_id, start_time=None, end_time=None):
     cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='incidents';")
     if cur.fetchone() is not None:
         if start_time and end_time:
+            timestamp_format = get_timestamp_format()
+            start_time = timestamps.coerce(start_time, timestamp_format)
+            end_time = timestamps.coerce(end_time, timestamp_format)
             cur.execute(
                 "SELECT datetime, event, sensor, value FROM incidents WHERE tab_id=? AND datetime BETWEEN ? AND ?",
                 (tab_id, start_time, end_time))
@@ -198,6 +271,7 @@ def tab(tab_id):
 
     start_time_str = request.args.get('start_time')
     end_time_str = request.args.get('end_time')
+    points = request.args.get('points', DEFAULT_POINTS, type=int)
 
     if request.method == 'POST':
         cur.execute("SELECT * FROM ranges WHERE tab_id = ?", (tab_id,))
@@ -272,6 +346,7 @@ def tab(tab_id):
             data_table_aliases = tab_settings[2:7:2]
             data_db = get_db('instance/sorted_data.db')
             cur2 = data_db.cursor()
+            timestamp_format = get_timestamp_format()
 
             if not start_time_str and not end_time_str:
                 end_time = datetime.now()  # используйте datetime напрямую
@@ -282,19 +357,19 @@ def tab(tab_id):
             for idx, (table, alias) in enumerate(zip(data_tables, data_table_aliases)):
                 # cur2.execute(f"SELECT * FROM {table} ORDER BY timestamp DESC;")
                 if start_time_str and end_time_str:
-                    # Преобразование строковых значений в дату/время (если это необходимо)
-                    start_time = start_time_str  # возможно, требуется дополнительное преобразование
-                    end_time = end_time_str  # аналогично
+                    # Границы приводятся к формату хранения, иначе сравнение 'Z' и '+00:00' как строк ломается
+                    start_time = timestamps.coerce(start_time_str, timestamp_format)
+                    end_time = timestamps.coerce(end_time_str, timestamp_format)
 
-                    cur2.execute(f"SELECT * FROM {table} WHERE timestamp BETWEEN ? AND ?", (start_time, end_time))
+                    data, resolution = load_series(cur2, table, start_time, end_time, points, timestamp_format)
                 else:
                     cur2.execute(f"SELECT * FROM {table} ORDER BY timestamp DESC;")
-                data = cur2.fetchall()
-                timestamps = [row[1] for row in data]
+                    data = cur2.fetchall()
+                record_times = [row[1] for row in data]
                 values = [row[2] for row in data]
 
-                temp_df = pd.DataFrame({'Время': timestamps, alias: values})
-                temp_df['Время'] = pd.to_datetime(temp_df['Время'], format='ISO8601').dt.round('1T')
+                temp_df = pd.DataFrame({'Время': record_times, alias: values})
+                temp_df['Время'] = to_datetime_series(temp_df['Время'], timestamp_format).dt.round('1T')
                 temp_df = temp_df.groupby('Время').mean().reset_index()
 
                 # Фильтруем аномальные значения для текущего temp_df на графике
@@ -302,8 +377,8 @@ def tab(tab_id):
 
                 if final_df.empty:
                     ids = [row[0] for row in data]  # добавляем столбец ID только один раз
-                    final_df = pd.DataFrame({'ID': ids, 'Время': timestamps})
-                    final_df['Время'] = pd.to_datetime(final_df['Время']).dt.round('1s')
+                    final_df = pd.DataFrame({'ID': ids, 'Время': record_times})
+                    final_df['Время'] = to_datetime_series(final_df['Время'], timestamp_format).dt.round('1s')
                 final_df = final_df.iloc[::-1]
                 # Объединяем основной DataFrame с данными текущего датчика
                 final_df = pd.merge(final_df, temp_df, on='Время', how='outer')
@@ -421,6 +496,31 @@ def tab(tab_id):
                                    incidents=incidents)
 
 
+@app.route('/api/series/<table_name>')
+def api_series(table_name):
+    if table_name not in get_table_names():
+        return jsonify({'error': f'Unknown sensor table {table_name}'}), 404
+
+    end_time = timestamps.to_datetime(request.args['end_time']) if 'end_time' in request.args \
+        else datetime.now(pytz.UTC)
+    start_time = timestamps.to_datetime(request.args['start_time']) if 'start_time' in request.args \
+        else end_time - timedelta(days=1)
+    points = request.args.get('points', DEFAULT_POINTS, type=int)
+
+    timestamp_format = get_timestamp_format()
+    cur = get_db(DATABASE1).cursor()
+    rows, resolution = load_series(cur, table_name, timestamps.from_datetime(start_time, timestamp_format),
+                                   timestamps.from_datetime(end_time, timestamp_format), points, timestamp_format)
+    cur.close()
+    return jsonify({
+        'table': table_name,
+        'resolution': resolution or 'raw',
+        'points': [{'time': timestamps.to_datetime(timestamp).isoformat(), 'avg': avg_value, 'min': min_value,
+                    'max': max_value, 'count': count}
+                   for _, timestamp, avg_value, min_value, max_value, count in rows],
+    })
+
+
 @app.route('/save_tab_settings', methods=['POST'])
 def save_tab_settings():
     tab_id = request.form['tab_id']
@@ -689,7 +789,7 @@ def format_datetime(value):
     if value is None:
         return ""
 
-    dt = parse(value)
+    dt = timestamps.to_datetime(value)
     return dt.strftime('%Y-%m-%d %H:%M:%S')
 
 